@@ -0,0 +1,54 @@
+# Parses a generated source that is mostly comments, blank lines and indentation and compares the
+# time per line with the mixed source from parse_scaling.py. Skipping a comment line should be
+# much cheaper than parsing a line of code, so this fails if it is not.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from parse_scaling import generate_source, measure  # pylint: disable=wrong-import-position
+
+
+LINES_COUNT = 10000
+
+
+def generate_comment_heavy_source(lines_count):
+    lines = []
+    for i in range(lines_count):
+        kind = i % 8
+        if kind == 0:
+            lines.append(f"label{i}:\tmov\t#{i % 100}., r{i % 6}\t\t; {'load the counter ' * 4}")
+        elif kind == 1:
+            lines.append("")
+        elif kind == 2:
+            lines.append(";" * 78)
+        elif kind == 3:
+            lines.append(f"; Block {i}: " + "lorem ipsum dolor sit amet " * 3)
+        elif kind == 4:
+            lines.append("\t\t\t\t; indented comment with a ; nested semicolon")
+        elif kind == 5:
+            lines.append(" " * 40)
+        elif kind == 6:
+            lines.append(f"\t.word\tlabel{i - 6}\t; {'x' * 60}")
+        else:
+            lines.append(";")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    code_elapsed = measure(generate_source(LINES_COUNT), repeat=3)
+    comment_elapsed = measure(generate_comment_heavy_source(LINES_COUNT), repeat=3)
+
+    code_per_line = code_elapsed / LINES_COUNT
+    comment_per_line = comment_elapsed / LINES_COUNT
+    print(f"Mostly code:     {code_elapsed:8.3f}s, {code_per_line * 1e6:7.1f}us per line")
+    print(f"Mostly comments: {comment_elapsed:8.3f}s, {comment_per_line * 1e6:7.1f}us per line")
+
+    if comment_per_line >= code_per_line:
+        print("Comments and whitespace are as expensive as code")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
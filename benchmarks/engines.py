@@ -0,0 +1,67 @@
+# Compiles a generated program with the deferred and the two-pass engines and compares the time per
+# line. Both engines must produce the same binary, so this fails if they do not.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pdpy11 import reports  # pylint: disable=wrong-import-position
+from pdpy11.compiler import Compiler  # pylint: disable=wrong-import-position
+from pdpy11.parser import parse  # pylint: disable=wrong-import-position
+
+
+# The program must fit in 64 KiB
+LINES_COUNT = 8000
+
+
+def generate_source(lines_count):
+    # Mostly code referring to labels far ahead, so that few addresses are known when the code
+    # using them is compiled
+    lines = []
+    for i in range(lines_count):
+        kind = i % 4
+        if kind == 0:
+            lines.append(f"label{i}: mov label{i + 1000}, r{i % 6}")
+        elif kind == 1:
+            lines.append(f"    .word label{(i + 3000) // 4 * 4}, label{i - 1} - .")
+        elif kind == 2:
+            lines.append(f"    jmp @#label{(i + 500) // 4 * 4}")
+        else:
+            lines.append("    beq 1$\n1$: .byte 1, 2, 3\n.even")
+    for i in range(lines_count, lines_count + 4000, 4):
+        lines.append(f"label{i}:")
+    return "\n".join(lines) + "\n"
+
+
+def report_handler(priority, identifier, *lst_reports):
+    raise Exception(f"Unexpected report while compiling the benchmark: {identifier} {lst_reports}")
+
+
+def measure(file, engine, repeat):
+    best = float("+inf")
+    with reports.handle_reports(report_handler):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = Compiler(engine=engine).compile_and_link_files([file])
+            best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    with reports.handle_reports(report_handler):
+        file = parse("benchmark.mac", generate_source(LINES_COUNT))
+
+    results = {}
+    for engine in ("deferred", "twopass"):
+        elapsed, results[engine] = measure(file, engine, repeat=3)
+        print(f"{engine + ':':9} {elapsed:8.3f}s, {elapsed / LINES_COUNT * 1e6:7.1f}us per line")
+
+    if results["deferred"] != results["twopass"]:
+        print("The engines produce different binaries", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Parses generated sources of 1k, 10k and 100k lines and fails if the time per
+# line grows noticeably with the size of the file, i.e. if parsing is no longer
+# linear.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pdpy11 import reports  # pylint: disable=wrong-import-position
+from pdpy11.parser import parse  # pylint: disable=wrong-import-position
+
+
+SIZES = (1000, 10000, 100000)
+
+# Time per line on the largest source may be at most this many times worse than on the smallest
+# one. Anything quadratic blows way past this.
+MAX_SLOWDOWN = 2.0
+
+
+def generate_source(lines_count):
+    lines = []
+    for i in range(lines_count):
+        kind = i % 4
+        if kind == 0:
+            lines.append(f"label{i}: mov #{i % 100}., r{i % 6}  ; comment {i}")
+        elif kind == 1:
+            lines.append(f"    .word label{i - 1}, 1 + 2 * 3, . - label{i - 1}")
+        elif kind == 2:
+            lines.append(f"    value{i} = label{i - 2} + 4")
+        else:
+            lines.append("    beq 1$\n1$: .byte 1, 2, 3  ; another comment")
+    return "\n".join(lines[:lines_count]) + "\n"
+
+
+def report_handler(priority, identifier, *lst_reports):
+    raise Exception(f"Unexpected report while parsing the benchmark: {identifier} {lst_reports}")
+
+
+def measure(source, repeat):
+    best = float("+inf")
+    with reports.handle_reports(report_handler):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parse("benchmark.mac", source)
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    per_line = {}
+    for lines_count in SIZES:
+        source = generate_source(lines_count)
+        elapsed = measure(source, repeat=max(1, 10000 // lines_count))
+        per_line[lines_count] = elapsed / lines_count
+        print(f"{lines_count:>7} lines: {elapsed:8.3f}s, {per_line[lines_count] * 1e6:7.1f}us per line")
+
+    slowdown = per_line[SIZES[-1]] / per_line[SIZES[0]]
+    print(f"Slowdown per line from {SIZES[0]} to {SIZES[-1]} lines: {slowdown:.2f}x")
+    if slowdown > MAX_SLOWDOWN:
+        print(f"Parsing grows superlinearly (more than {MAX_SLOWDOWN}x slower per line)", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
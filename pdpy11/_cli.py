@@ -8,10 +8,11 @@ import traceback
 # Importing bk_encoding is not pure
 from . import bk_encoding  # pylint: disable=unused-import
 
+from .cache import ASTCache
 from .compiler import Compiler
 from .devices import open_device
 from .formats import file_formats
-from . import parser
+from .parallel import parse_files
 from . import reports
 from .version import __version__ as version
 
@@ -30,6 +31,11 @@ argparser.add_argument("--report-format", choices=["graphical", "bare"], default
 
 argparser.add_argument("-W", metavar="xxx", dest="warnings", action="append", type=str, help="enable warning xxx, use '-Wno-xxx' to disable, '-Wall' to enable all. Only few critical warnings are enabled by default (-Wdefault)")
 
+argparser.add_argument("-j", metavar="N", dest="jobs", type=int, default=1, help="parse input and included files in N processes (default: 1)")
+argparser.add_argument("--stream", action="store_true", help="compile every statement right after it is parsed instead of parsing whole files first, to save memory on huge sources. Ignores --cache and -j")
+argparser.add_argument("--engine", choices=["deferred", "twopass"], default="deferred", help="how forward references are resolved: 'deferred' compiles every statement right away and fills in unknown values later, 'twopass' lays out the whole program first and then emits it, so that fewer values are deferred. The output is the same. --stream always uses 'deferred'")
+argparser.add_argument("--cache", action="store_true", help="reuse ASTs of unchanged source files cached in ~/.cache/pdpy11 by previous runs instead of parsing them again. The cache is never cleaned up automatically")
+
 argparser.add_argument("--version", "-v", action="version", version=f"%(prog)s {version} running on {platform.python_implementation()} {platform.python_version()}")
 
 
@@ -37,6 +43,11 @@ def main_cli():
     args = argparser.parse_args()
 
 
+    if args.jobs < 1:
+        print("The number of jobs must be positive", file=sys.stderr)
+        sys.exit(1)
+
+
     try:
         codecs.lookup(args.charset)
     except LookupError:
@@ -90,12 +101,22 @@ def main_cli():
 
     try:
         with reports.handle_reports(report_handler):
-            parsed_files = []
-            for path, source in files_to_parse:
-                parsed_files.append(parser.parse(path, source))
+            comp = Compiler(output_charset=args.charset, ast_cache=ASTCache() if args.cache else None, engine=args.engine)
+
+            if args.stream:
+                base, code = comp.compile_and_link_sources(files_to_parse)
+            else:
+                if args.jobs > 1 and len(files_to_parse) > 1:
+                    parsed_files = parse_files(files_to_parse, min(args.jobs, len(files_to_parse)), comp.ast_cache)
+                else:
+                    parsed_files = []
+                    for path, source in files_to_parse:
+                        parsed_files.append(comp.parse(path, source))
+
+                if args.jobs > 1:
+                    comp.prefetch_includes(parsed_files, args.jobs)
 
-            comp = Compiler(output_charset=args.charset)
-            base, code = comp.compile_and_link_files(parsed_files)
+                base, code = comp.compile_and_link_files(parsed_files)
 
 
         with reports.handle_reports(report_handler):
@@ -0,0 +1,94 @@
+import glob
+import hashlib
+import os
+import pickle
+import tempfile
+import zlib
+
+from . import parser
+from . import reports
+from .version import __version__
+
+
+def hash_package_sources():
+    # The version is not enough to tell ASTs apart: in a source checkout, changes to the grammar or
+    # the AST classes don't bump it, and an AST unpickled into classes it was not made by breaks in
+    # confusing ways much later. So the key covers the code of pdpy11 itself.
+    key = hashlib.sha256(f"{__version__}\0".encode())
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))):
+        with open(path, "rb") as f:
+            key.update(f.read())
+    return key.digest()
+
+
+def default_cache_directory():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pdpy11")
+
+
+class ASTCache:
+    # Parsed files are stored under a hash of their contents, so a file that has not changed since
+    # the last run is unpickled instead of parsed. Entries made by any other code of pdpy11 are
+    # simply never looked up again. Nothing is ever evicted, which is why the cache is opt-in.
+
+    def __init__(self, directory=None):
+        self.directory = directory or default_cache_directory()
+        self.code_hash = hash_package_sources()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get_path(self, code):
+        key = hashlib.sha256(self.code_hash)
+        key.update(code.encode("utf-8", "surrogatepass"))
+        digest = key.hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+
+    def load(self, path):
+        try:
+            with open(path, "rb") as f:
+                return pickle.loads(zlib.decompress(f.read()))
+        except OSError:
+            return None
+        except (zlib.error, pickle.UnpicklingError, EOFError):
+            # A truncated or otherwise broken entry is as good as a missing one
+            return None
+
+
+    def store(self, path, file):
+        data = zlib.compress(pickle.dumps(file, protocol=pickle.HIGHEST_PROTOCOL))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so that concurrent runs never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            # The cache is an optimization; a read-only or full disk must not break the build
+            pass
+
+
+    def parse(self, filename, code):
+        path = self.get_path(code)
+
+        file = self.load(path)
+        if file is not None:
+            self.hits += 1
+            # The same contents may live under another name
+            file.filename = filename
+            file.body.source.filename = filename
+            return file
+
+        self.misses += 1
+        emitted_count = reports.emitted_count
+        file = parser.parse(filename, code)
+        # Diagnostics are not stored, so only files that parse cleanly can be cached
+        if reports.emitted_count == emitted_count:
+            self.store(path, file)
+        return file
@@ -1,20 +1,28 @@
 import collections
+import contextlib
+import os
+import pickle
 import struct
 import sys
 
 from .builtins import builtin_commands
 from .containers import CaseInsensitiveDict
-from .deferred import Promise, wait, BaseDeferred, Deferred, SizedDeferred, DeferredCycle
+from .deferred import Promise, wait, Address, Rope, BaseDeferred, Deferred, SizedDeferred, DeferredCycle, put_off
 from .devices import open_device
 from .formats import file_formats
 from .metacommand_impl import get_as_int
 from . import operators
-from .types import Instruction, Label, Assignment, InstructionPointer, WordList, ParenthesizedExpression
+from . import parallel
+from . import parser
+from .types import Instruction, Label, Assignment, InstructionPointer, WordList, CodeBlock, ParenthesizedExpression, AngleBracketedChar, StringConcatenation, Symbol
 from . import reports
 
 
 class Compiler:
-    def __init__(self, output_charset="bk"):
+    def __init__(self, output_charset="bk", ast_cache=None, engine="deferred"):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of: {', '.join(ENGINES)}")
+        self.engine = engine
         self.symbols = CaseInsensitiveDict()
         self.extern_symbols_mapping = CaseInsensitiveDict()
         self.emitted_files = []
@@ -23,12 +31,102 @@ class Compiler:
         self.next_internal_symbol_prefix = 1
         self.times_file_compiled = collections.defaultdict(int)
         self.internal_prefix_to_state = {}
+        self.ast_cache = ast_cache
+        self.prefetched_includes = {}
+        self.prefetched_insertions = {}
+        # path -> (mtime, pickled AST). Compiling an AST mutates it, so every inclusion gets a fresh
+        # copy.
+        self.include_cache = {}
+        self.once_guarded_files = set()
+        # (insn, state, symbols referenced) for every variable, in the order they were defined
+        self.assignments = []
+        self.assignment_by_name = CaseInsensitiveDict()
+        # Indices of variables that could not be computed right when they were defined
+        self.deferred_assignments = []
+        # Lowercased names that variables referred to before they were defined
+        self.forward_references = set()
+        # Statements of a known size that wait for the whole program to be laid out, when the
+        # two-pass engine is used
+        self.postponed = None
+        # Statements are numbered in the order they are written. Reports are held back and tagged
+        # with the number of the statement being compiled, see reports_in_statement_order
+        self.statement_number = 0
+        self.next_statement_number = 0
+
+
+    def parse(self, filename, code):
+        if self.ast_cache is None:
+            return parser.parse(filename, code)
+        return self.ast_cache.parse(filename, code)
+
+
+    def prefetch_includes(self, files, jobs):
+        self.prefetched_includes, self.prefetched_insertions = parallel.prefetch_includes(files, jobs, self.ast_cache)
+
+
+    def take_prefetched_include(self, path):
+        # Compiling an AST mutates it, so a prefetched file is only handed out once; including the
+        # same file again reads and parses it anew
+        prefetched = self.prefetched_includes.pop(path, None)
+        if prefetched is None:
+            return None
+        file, recorded = prefetched
+        for priority, identifier, lst_reports in recorded:
+            priority(identifier, *lst_reports)
+        if file is not None and not recorded:
+            self.remember_include(path, file)
+        return file
+
+
+    def load_include(self, path):
+        # Returns a fresh AST of a file that has been included before and has not changed since, or
+        # None
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self.include_cache.get(path)
+        if cached is None or cached[0] != mtime:
+            return None
+        return pickle.loads(cached[1])
+
+
+    def parse_include(self, path, code):
+        emitted_count = reports.emitted_count
+        file = self.parse(path, code)
+        # Reports would not be emitted again on the next inclusion, so don't cache files with any
+        if reports.emitted_count == emitted_count:
+            self.remember_include(path, file)
+        return file
+
+
+    def remember_include(self, path, file):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        self.include_cache[path] = (mtime, pickle.dumps(file, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+    def is_included_once(self, path):
+        # A file that starts with .once produces no code when it is compiled for the second time, so
+        # there is no need to even read it
+        if path in self.once_guarded_files:
+            self.times_file_compiled[path] += 1
+            return True
+        return False
 
 
     def compile_file(self, file, start, link_base):
-        self.times_file_compiled[file.filename] += 1
+        return self.compile_file_statements(file.filename, file.body.insns, start, link_base)
+
+
+    def compile_file_statements(self, filename, insns, start, link_base):
+        # insns may be a generator, in which case every statement can be freed as soon as it is
+        # compiled and whatever it emitted has been computed
+        self.times_file_compiled[filename] += 1
         state = {
-            "filename": file.filename,
+            "filename": filename,
             "context": "file",
             "internal_symbol_prefix": f".internal{self.next_internal_symbol_prefix}.",
             "compiler": self,
@@ -38,35 +136,90 @@ class Compiler:
         }
         self.internal_prefix_to_state[self.next_internal_symbol_prefix] = state
         self.next_internal_symbol_prefix += 1
-        return self.compile_block(state, file.body, start)
+        return self.compile_statements(state, self.watch_once_guard(filename, insns), start)
+
+
+    def watch_once_guard(self, filename, insns):
+        is_first = True
+        for insn in insns:
+            if is_first and isinstance(insn, Instruction) and insn.name.name.lower() in (".once", "once"):
+                self.once_guarded_files.add(filename)
+            is_first = False
+            yield insn
+
+
+    def number_statements(self, insns):
+        # The next statement is numbered before it is fetched, so that if it is parsed on the fly,
+        # the reports of the parser are sorted along with it
+        insns = iter(insns)
+        while True:
+            self.next_statement_number += 1
+            self.statement_number = self.next_statement_number
+            try:
+                insn = next(insns)
+            except StopIteration:
+                return
+            yield insn
+
+
+    @contextlib.contextmanager
+    def reports_in_statement_order(self):
+        # Statements of a known size are compiled after the ones that follow them, so the reports
+        # are held back until the program is laid out and then emitted in the order of the
+        # statements they come from
+        held = []
+        def report_handler(priority, identifier, *lst_reports):
+            # The parser keeps moving the contexts it passes, so the positions have to be taken now
+            held.append((self.statement_number, priority, identifier, [(start.at(start.pos), end.at(end.pos), text) for start, end, text in lst_reports]))
+
+        handler = reports.handle_reports(report_handler)
+        try:
+            with handler:
+                try:
+                    yield
+                finally:
+                    # Errors are for the handler the reports are emitted to in the end to find out
+                    handler.is_error_condition = False
+        finally:
+            held.sort(key=lambda report: report[0])
+            for _, priority, identifier, lst_reports in held:
+                priority(identifier, *lst_reports)
 
 
     def compile_block(self, state, block, start):
-        addr = start
-        data = b""
+        return self.compile_statements(state, block.insns, start)
+
+
+    def compile_statements(self, state, insns, start):
+        addr = Address[int](start)
+        data = Rope[bytes]()
 
         local_symbol_prefix = f".local{self.next_local_symbol_prefix}."
         self.next_local_symbol_prefix += 1
 
+        # The size of CPU instructions and data is known before their operands are, so they are
+        # compiled a bit later, when the labels that follow them are already defined and forward
+        # references to those don't have to be deferred
+        postponed = [] if self.postponed is None else self.postponed
+
         try:
-            for insn in block.insns:
+            for insn in self.number_statements(insns):
                 state = {**state, "insn": insn, "emit_address": addr, "local_symbol_prefix": local_symbol_prefix}
                 if isinstance(insn, Instruction):
+                    size = self.get_static_size(insn)
+                    if size is not None:
+                        self.postpone(postponed, data.reserve(size), insn, state)
+                        addr = Address[int](addr, size)
+                        continue
+
                     chunk = self.compile_insn(insn, state)
                     if chunk is not None:
-                        data += chunk
-                        if isinstance(chunk, BaseDeferred):
-                            addr += chunk.length()
-                        else:
-                            addr += len(chunk)
+                        data.append(chunk)
+                        addr = Address[int](addr, chunk.length() if isinstance(chunk, BaseDeferred) else len(chunk))
 
                 elif isinstance(insn, WordList):
-                    chunk = self.compile_word_list(insn, insn.words, state)
-                    data += chunk
-                    if isinstance(chunk, BaseDeferred):
-                        addr += chunk.length()
-                    else:
-                        addr += len(chunk)
+                    self.postpone(postponed, data.reserve(2 * len(insn.words)), insn, state)
+                    addr = Address[int](addr, 2 * len(insn.words))
 
                 elif isinstance(insn, Label):
                     if state["context"] == "repeat":
@@ -89,7 +242,7 @@ class Compiler:
                         if state["link_base"]["promise"].settled:
                             # Bring the current address forward
                             def closure(insn):
-                                nonlocal data, addr
+                                nonlocal addr
                                 def fn():
                                     old_addr_value = wait(addr)
                                     new_addr_value = get_as_int(state, "link address", state["insn"], insn.value, bitness=16, unsigned=False)
@@ -103,11 +256,8 @@ class Compiler:
                                     return b"\x00" * length
 
                                 chunk = Deferred[bytes](fn)
-                                data += chunk
-                                if isinstance(chunk, BaseDeferred):
-                                    addr += chunk.length()
-                                else:
-                                    addr += len(chunk)
+                                data.append(chunk)
+                                addr = Address[int](addr, chunk.length() if isinstance(chunk, BaseDeferred) else len(chunk))
                             closure(insn)
                         else:
                             # Set link base
@@ -131,9 +281,52 @@ class Compiler:
         except CompilerStopIteration:
             pass
 
+        if postponed is not self.postponed:
+            self.compile_postponed(postponed)
+
         return data
 
 
+    def get_static_size(self, insn):
+        command = builtin_commands.get(insn.name.name)
+        return None if command is None else command.get_size(insn)
+
+
+    def postpone(self, postponed, hole, insn, state):
+        postponed.append((hole, insn, state, self.statement_number))
+        # The two-pass engine waits for the whole program, otherwise only so many statements wait
+        if postponed is not self.postponed and len(postponed) >= MAX_POSTPONED_STATEMENTS:
+            self.compile_postponed(postponed)
+
+
+    def compile_postponed(self, postponed):
+        for hole, insn, state, statement_number in postponed:
+            self.statement_number = statement_number
+            if isinstance(insn, WordList):
+                with self.put_off_if_not_ready(insn.words, state):
+                    hole.chunk = self.compile_word_list(insn, insn.words, state)
+            else:
+                with self.put_off_if_not_ready(insn.operands, state):
+                    hole.chunk = self.compile_insn(insn, state)
+        postponed.clear()
+
+
+    def put_off_if_not_ready(self, exprs, state):
+        # Code referring to a symbol that is not defined yet, or to a value that is known to be
+        # missing something, can't be computed now, so it is not tried to be until the end
+        for expr in exprs:
+            for symbol in iter_symbols(expr):
+                if not symbol.is_necessarily_label and symbol.name.lower() in parser.REGISTER_NAMES:
+                    continue
+                name = self.find_symbol(state, symbol.name)
+                if name is None:
+                    return put_off
+                value = self.symbols[name][1]
+                if isinstance(value, BaseDeferred) and not value.is_ready():
+                    return put_off
+        return contextlib.nullcontext()
+
+
     def compile_label(self, label, addr, state):
         if label.local:
             name = state["local_symbol_prefix"] + label.name
@@ -173,7 +366,10 @@ class Compiler:
             return
 
         state["internal_symbols_list"].append(insn.target.name)
-        self.symbols[name] = (insn, Deferred[int](lambda: insn.value.resolve(state), insn.target.name))
+        with self.put_off_if_not_ready([insn.value], state):
+            value = Deferred[int](lambda: insn.value.resolve(state), insn.target.name)
+        self.symbols[name] = (insn, value)
+        self.add_assignment(name, insn, value, state)
 
         if insn.is_extern:
             self.declare_external_symbol(insn, insn.target.name, state)
@@ -182,6 +378,101 @@ class Compiler:
             self.declare_external_symbol(state["extern_all"], insn.target.name, state)
 
 
+    def find_symbol(self, state, name):
+        # Returns the key under which the symbol called 'name' in the given scope is stored in
+        # self.symbols, or None if it is not defined (yet)
+        for full_name in (state["local_symbol_prefix"] + name, state["internal_symbol_prefix"] + name):
+            if full_name in self.symbols:
+                return full_name
+
+        extern_mapping = self.extern_symbols_mapping.get(name)
+        if extern_mapping and extern_mapping[1] in self.symbols:
+            return extern_mapping[1]
+
+        return None
+
+
+    def add_assignment(self, name, insn, value, state):
+        index = len(self.assignments)
+        self.assignment_by_name[name] = index
+
+        if not isinstance(value, BaseDeferred):
+            # Already computed, so it can't be a part of a cycle
+            self.assignments.append((insn, state, []))
+            return
+
+        references = list(iter_symbols(insn.value))
+        self.assignments.append((insn, state, references))
+        self.deferred_assignments.append(index)
+
+        is_referenced_in_advance = False
+        for symbol in references:
+            full_name = self.find_symbol(state, symbol.name)
+            if full_name is None:
+                self.forward_references.add((state["internal_symbol_prefix"] + symbol.name).lower())
+                self.forward_references.add(symbol.name.lower())
+            elif full_name.lower() == name.lower():
+                is_referenced_in_advance = True
+
+        # A cycle is closed by the last of its variables to be defined, which the others must have
+        # referred to in advance. It has to be found right away, because waiting on any variable of
+        # the cycle would never return.
+        if is_referenced_in_advance or name.lower() in self.forward_references or insn.target.name.lower() in self.forward_references:
+            for component in strongly_connected_components([index], self.get_assignment_dependencies):
+                if is_cyclic(component, self.get_assignment_dependencies):
+                    self.report_recursive_definition(component)
+
+
+    def get_assignment_dependencies(self, index):
+        insn, state, references = self.assignments[index]
+        if not isinstance(self.symbols[state["internal_symbol_prefix"] + insn.target.name][1], BaseDeferred):
+            # Already computed, or replaced after a cycle was found
+            return []
+
+        dependencies = []
+        for symbol in references:
+            full_name = self.find_symbol(state, symbol.name)
+            if full_name is not None:
+                dependency = self.assignment_by_name.get(full_name)
+                if dependency is not None:
+                    dependencies.append(dependency)
+        return dependencies
+
+
+    def report_recursive_definition(self, component):
+        component = sorted(component)
+        insns = [self.assignments[i][0] for i in component]
+        reports.error(
+            "recursive-definition",
+            (insns[0].ctx_start, insns[0].ctx_end, f"Variable '{insns[0].target.name}' is defined in terms of itself" if len(insns) == 1 else f"Variable '{insns[0].target.name}' depends on itself"),
+            *[
+                (insn.ctx_start, insn.ctx_end, f"...through '{insn.target.name}', which is defined here")
+                for insn in insns[1:]
+            ]
+        )
+
+        for i in component:
+            insn, state, _ = self.assignments[i]
+            name = state["internal_symbol_prefix"] + insn.target.name
+            _, value = self.symbols[name]
+            # The value may be shared with other variables or captured by expressions already, so
+            # settle it in place
+            if isinstance(value, Deferred):
+                value.settle(0)
+            self.symbols[name] = (insn, 0)
+
+
+    def resolve_symbols(self):
+        # Variables are computed in dependency order, so each of them finds the ones it refers to
+        # already computed and no definition is walked through more than once
+        for component in strongly_connected_components(self.deferred_assignments, self.get_assignment_dependencies):
+            if is_cyclic(component, self.get_assignment_dependencies):
+                self.report_recursive_definition(component)
+            else:
+                insn, state, _ = self.assignments[component[0]]
+                wait(self.symbols[state["internal_symbol_prefix"] + insn.target.name][1])
+
+
     def set_link_address(self, address, state):
         if state["link_base"]["promise"].settled:
             prev_link = state["link_base"]["set_where"]
@@ -298,6 +589,10 @@ class Compiler:
             "set_where": None
         }
 
+        # An included file is linked where it is included, unless it says otherwise
+        if not sets_link_address(file.body.insns):
+            link_base["promise"].settle(addr)
+
         code = self.compile_file(file, link_base["promise"], link_base)
 
         if not link_base["promise"].settled:
@@ -307,31 +602,58 @@ class Compiler:
 
 
     def compile_and_link_files(self, files_ast):
+        files_ast = list(files_ast)
+        # Unless some file may set the link base, it is known to be the default before anything is
+        # compiled, so addresses are plain numbers from the start rather than expressions in LA
+        link_base_is_default = not any(sets_link_address(file_ast.body.insns) for file_ast in files_ast)
+        return self.compile_and_link_statements(((file_ast.filename, file_ast.body.insns) for file_ast in files_ast), link_base_is_default, two_pass=self.engine == "twopass")
+
+
+    def compile_and_link_sources(self, files):
+        # Streaming mode: every (filename, code) pair is parsed statement by statement, and each
+        # statement is compiled right after it is parsed, so the AST of a file is never held in
+        # memory as a whole. The two-pass engine would hold all of it, so it is not used here
+        return self.compile_and_link_statements((filename, parser.iter_statements(filename, code)) for filename, code in files)
+
+
+    def compile_and_link_statements(self, files, link_base_is_default=False, two_pass=False):
+        # The two-pass engine lays out the whole program first, defining all symbols and compiling
+        # metacommands in order, and compiles instructions and data once everything is laid out.
+        # Whatever can't be laid out in advance, e.g. '.blkb n' before 'n' is defined, is deferred
+        # just like the deferred engine does, so that addresses after it are computed later
+        if two_pass:
+            self.postponed = []
+
         link_base = {
             "promise": Promise[int]("LA"),
             "set_where": None
         }
+        if link_base_is_default:
+            link_base["promise"].settle(DEFAULT_LINK_ADDRESS)
 
-        addr = link_base["promise"]
-        generated_code = b""
+        addr = Address[int](link_base["promise"])
+        generated_code = Rope[bytes]()
 
-        for file_ast in files_ast:
-            data = self.compile_file(file_ast, addr, link_base)
-            generated_code += data
-            if isinstance(data, BaseDeferred):
-                addr += data.length()
-            else:
-                addr += len(data)
+        with self.reports_in_statement_order():
+            for filename, insns in files:
+                data = self.compile_file_statements(filename, insns, addr, link_base)
+                generated_code.append(data)
+                addr = Address[int](addr, data.length())
 
-        if not link_base["promise"].settled:
-            link_base["promise"].settle(0o1000)
+            if two_pass:
+                self.compile_postponed(self.postponed)
+                self.postponed = None
 
-        base, code = wait(link_base["promise"]), wait(generated_code)
+        if not link_base["promise"].settled:
+            link_base["promise"].settle(DEFAULT_LINK_ADDRESS)
 
         # Resolve all symbols, in case some have not been used
+        self.resolve_symbols()
         for _, (_, value) in self.symbols.items():
             wait(value)
 
+        base, code = wait(link_base["promise"]), wait(generated_code)
+
         return base, code
 
 
@@ -395,3 +717,93 @@ class Compiler:
 
 class CompilerStopIteration(Exception):
     pass
+
+
+ENGINES = ("deferred", "twopass")
+
+DEFAULT_LINK_ADDRESS = 0o1000
+
+# How many statements may wait for the labels after them to be defined. Forward references any
+# further than that are deferred, and reports are emitted not too far from where they belong
+MAX_POSTPONED_STATEMENTS = 1024
+
+
+def sets_link_address(insns):
+    # Whether any statement, including those in code blocks, may set the link base
+    stack = list(insns)
+    while stack:
+        insn = stack.pop()
+        if isinstance(insn, Assignment) and isinstance(insn.target, InstructionPointer):
+            return True
+        elif isinstance(insn, Instruction):
+            if insn.name.name.lower() in ("link", ".link"):
+                return True
+            for operand in insn.operands:
+                if isinstance(operand, CodeBlock):
+                    stack += operand.insns
+    return False
+
+
+def iter_symbols(expr):
+    stack = [expr]
+    while stack:
+        token = stack.pop()
+        if isinstance(token, Symbol):
+            yield token
+        elif isinstance(token, operators.InfixOperator):
+            stack += (token.lhs, token.rhs)
+        elif isinstance(token, operators.UnaryOperator):
+            stack.append(token.operand)
+        elif isinstance(token, (ParenthesizedExpression, AngleBracketedChar)):
+            stack.append(token.expr)
+        elif isinstance(token, StringConcatenation):
+            stack += token.chunks
+
+
+def strongly_connected_components(roots, get_dependencies):
+    # Tarjan's algorithm over the nodes reachable from roots, with an explicit stack so that long
+    # chains of definitions don't hit the recursion limit. Components are yielded in topological
+    # order, dependencies first.
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+
+    for root in roots:
+        if root in index:
+            continue
+
+        work = [(root, iter(get_dependencies(root)))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+
+        while work:
+            node, dependencies = work[-1]
+            for child in dependencies:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(get_dependencies(child))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    yield component
+                if work:
+                    parent, _ = work[-1]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+
+def is_cyclic(component, get_dependencies):
+    return len(component) > 1 or component[0] in get_dependencies(component[0])
@@ -1,14 +1,97 @@
-class Context:
-    def __init__(self, filename, code):
+import bisect
+
+from .lexer import Lexer, whitespace_regex
+
+
+def fold_case(code):
+    folded = code.lower()
+    if len(folded) == len(code):
+        return folded
+    # A few characters, like U+0130, lowercase to two code points. Leave those alone so that
+    # positions in the folded copy still match the original; no literal contains them anyway.
+    return "".join(char if len(char.lower()) != 1 else char.lower() for char in code)
+
+
+class Source:
+    # Everything that is computed once per file and shared by all contexts pointing into it
+    def __init__(self, filename, code, memo=None, lexer=None):
         self.filename = filename
         self.code = code
-        self.pos = 0
+        self.lexer = lexer or Lexer(code)
+        self.folded_code = fold_case(code)
+        self.memo = memo
+        self._line_starts = None
+        self._lines = None
+
+
+    def __getstate__(self):
+        # Only the parser needs the token table, and the line index is cheap to rebuild
+        state = self.__dict__.copy()
+        state.update(lexer=None, folded_code=None, memo=None, _line_starts=None, _lines=None)
+        return state
+
+
+    @property
+    def line_starts(self):
+        # Built lazily: most files are compiled without a single diagnostic
+        if self._line_starts is None:
+            self._line_starts = [0]
+            pos = self.code.find("\n")
+            while pos != -1:
+                self._line_starts.append(pos + 1)
+                pos = self.code.find("\n", pos + 1)
+        return self._line_starts
+
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = self.code.split("\n")
+        return self._lines
+
+
+    def line_of(self, pos):
+        return bisect.bisect_right(self.line_starts, pos) - 1
+
+
+    def line_and_column(self, pos):
+        # Both zero-based. Tabs are counted as four columns
+        line_no = self.line_of(pos)
+        idx_line_start = self.line_starts[line_no]
+        col_no = (pos - idx_line_start) + self.code.count("\t", idx_line_start, pos) * 3
+        return line_no, col_no
+
+
+class Context:
+    # The token table is looked up through the source rather than copied, because contexts end up
+    # in the AST and would otherwise keep it alive after parsing
+    __slots__ = ("source", "code", "pos")
+
+    def __init__(self, source, pos=0):
+        self.source = source
+        self.code = source.code
+        self.pos = pos
+
+
+    def __reduce__(self):
+        return Context, (self.source, self.pos)
+
+
+    @property
+    def filename(self):
+        # Not copied, so that renaming the source (e.g. when loading it from the cache) renames
+        # every context pointing into it
+        return self.source.filename
 
 
     def save(self):
-        ctx = Context(self.filename, self.code)
-        ctx.pos = self.pos
-        return ctx
+        return self.at(self.pos)
+
+
+    def at(self, pos):
+        # The parser backtracks with plain integer positions and only calls this for positions that
+        # end up in the AST or in a report
+        return Context(self.source, pos)
 
 
     def restore(self, ctx):
@@ -16,26 +99,23 @@ class Context:
 
 
     def skip_whitespace(self):
-        while self.pos < len(self.code):
-            if self.code[self.pos].strip() == "":
-                self.pos += 1
-            elif self.code[self.pos] == ";":
-                self.pos = self.code.find("\n", self.pos)
-                if self.pos == -1:
-                    self.pos = len(self.code)
-            else:
-                _ = 1  # For code coverage. CPython optimizes 'break' away otherwise
-                break
+        end = self.source.lexer.whitespace_end(self.pos)
+        if end == -1:
+            # Not at a token boundary, e.g. in the middle of a string literal
+            end = whitespace_regex.match(self.code, self.pos).end()
+        self.pos = end
 
 
     def eof(self):
-        copy = self.save()
-        copy.skip_whitespace()
-        return copy.code[copy.pos:].strip() == ""
+        # skip_whitespace stops at the first significant character, so there is no need to look at
+        # the rest of the file
+        pos = self.pos
+        self.skip_whitespace()
+        is_eof = self.pos >= len(self.code)
+        self.pos = pos
+        return is_eof
 
 
     def __repr__(self):
-        line_no = self.code[:self.pos].count("\n")
-        idx_line_start = self.code.rfind("\n", 0, self.pos) + 1
-        col_no = (self.pos - idx_line_start) + self.code[idx_line_start:self.pos].count("\t") * 3
+        line_no, col_no = self.source.line_and_column(self.pos)
         return f"{self.filename}:{line_no + 1}:{col_no + 1}"
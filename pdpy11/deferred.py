@@ -1,19 +1,63 @@
+import functools
+import threading
+
+
 class NotReadyError(Exception):
-    pass
+    def __init__(self, is_ready):
+        super().__init__()
+        # Tells whether whatever was missing may be there now, without computing anything
+        self.is_ready = is_ready
 
 
 class DeferredCycle(Exception):
     pass
 
 
+# How many waits may be nested on the Python stack of one thread. Each level costs several frames,
+# so this stays well within the recursion limit.
+MAX_NESTED_WAITS = 64
+
+
 def wait(deferred):
     while isinstance(deferred, BaseDeferred):
         deferred = deferred.wait()
     return deferred
 
 
+def wait_on_fresh_stack(deferred):
+    # The stack is too deep to go on recursing, so the deferred is waited on by a thread of its own,
+    # which starts with an empty stack, while this one blocks. Only one thread runs at a time, so
+    # the awaiting stack and everything else is shared as if it all happened on one stack, and the
+    # computation that needed the deferred simply continues once it is there. Depth therefore
+    # doesn't depend on how long a chain of definitions is, and nothing is computed twice.
+    outcome = []
+
+    def run():
+        try:
+            outcome.append((True, deferred.wait()))
+        except BaseException as ex:  # pylint: disable=broad-except
+            outcome.append((False, ex))
+
+    stack_base = Awaiting.stack_base
+    Awaiting.stack_base = len(Awaiting.awaiting_stack)
+    try:
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+    finally:
+        Awaiting.stack_base = stack_base
+
+    succeeded, result = outcome[0]
+    if not succeeded:
+        raise result
+    return result
+
+
 class TryCompute:
     depth = 0
+    # Whether the last attempt found something not ready, and if so, how to tell if it is now
+    failed = False
+    is_ready = None
 
     def __enter__(self):
         self.depth += 1
@@ -21,13 +65,35 @@ class TryCompute:
 
     def __exit__(self, exc_type, exc_value, exc_tb):
         self.depth -= 1
-        return exc_type is NotReadyError
+        self.failed = exc_type is NotReadyError
+        if self.failed:
+            self.is_ready = exc_value.is_ready
+        return self.failed
 
 try_compute = TryCompute()
 
 
+class PutOff:
+    # Deferreds made inside are not tried to be computed right away. That is for code that is known
+    # to need something which is not there yet: finding that out in advance is much cheaper than
+    # from NotReadyError.
+    depth = 0
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.depth -= 1
+
+put_off = PutOff()
+
+
 class Awaiting:
+    __slots__ = ("deferred",)
     awaiting_stack = []
+    # Where the stack of the thread that is running starts
+    stack_base = 0
 
     def __init__(self, deferred):
         self.deferred = deferred
@@ -44,19 +110,28 @@ class Awaiting:
         self.deferred.is_awaiting = False
 
 
-def not_ready():
+def not_ready(is_ready):
     if try_compute.depth > 0:
-        raise NotReadyError()
+        raise NotReadyError(is_ready)
 
 
 class BaseDeferredMetaclass(type):
     def __getitem__(cls, typ):
-        if not isinstance(typ, type):
-            raise TypeError(f"{cls.__name__} must be passed a type in brackets, not {typ}")  # pragma: no cover
-        return lambda *args, **kwargs: cls.construct(typ, *args, **kwargs)
+        # Deferreds are made all the time, so the constructor for every type is made just once
+        constructor = constructors.get((cls, typ))
+        if constructor is None:
+            if not isinstance(typ, type):
+                raise TypeError(f"{cls.__name__} must be passed a type in brackets, not {typ}")  # pragma: no cover
+            constructor = functools.partial(cls.construct, typ)
+            constructors[(cls, typ)] = constructor
+        return constructor
+
+constructors = {}
 
 
 class BaseDeferred(metaclass=BaseDeferredMetaclass):
+    __slots__ = ("typ", "is_awaiting")
+
     def __new__(cls, *args, **kwargs):  # pylint: disable=unused-argument
         if not args or not isinstance(args[0], type):
             raise TypeError(f"{cls.__name__} must be passed a type in brackets")  # pragma: no cover
@@ -71,12 +146,19 @@ class BaseDeferred(metaclass=BaseDeferredMetaclass):
         return cls(*args, **kwargs)
 
     def wait(self):
+        if len(Awaiting.awaiting_stack) - Awaiting.stack_base > MAX_NESTED_WAITS:
+            return wait_on_fresh_stack(self)
         with Awaiting(self):
             return self._wait()
 
     def get_current_best_estimate(self):
         raise NotImplementedError(type(self).__name__ + ".get_current_best_estimate()")  # pragma: no cover
 
+    def is_ready(self):
+        # Tells without computing anything whether the value may be computed now. Only values known
+        # to be missing something say no, the others find out from NotReadyError
+        return True
+
     def _wait(self):
         raise NotImplementedError()  # pragma: no cover
 
@@ -153,17 +235,24 @@ class BaseDeferred(metaclass=BaseDeferredMetaclass):
 
 
 class Deferred(BaseDeferred):
+    __slots__ = ("fn", "value", "settled", "ready_check", "name")
+
     def __init__(self, typ, fn, name=None):
         super().__init__(typ)
         self.fn = fn
         self.value = None
         self.settled = False
+        # If the value could not be computed last time because something was missing, tells
+        # whether it may be there now
+        self.ready_check = None
         self.name = name or f"d{Deferred.next_instance_id}"
         Deferred.next_instance_id += 1
 
     @classmethod
     def construct(cls, *args):  # pylint: disable=arguments-differ
         tmp = cls(*args)
+        if put_off.depth > 0:
+            return tmp
         with try_compute:
             return tmp.wait()
         return tmp
@@ -188,8 +277,18 @@ class Deferred(BaseDeferred):
         if self.settled:
             return self.value
         else:
-            self.value = self.fn()
+            # Trying again while whatever was missing is still missing would fail the same way,
+            # only after computing everything else the value depends on once more
+            if not self.is_ready():
+                not_ready(self.ready_check)
+            try:
+                self.value = self.fn()
+            except NotReadyError as ex:
+                self.ready_check = ex.is_ready
+                raise
             self.settled = True
+            # The closure usually references the AST node the value was computed from
+            self.fn = None
             return self.value
 
     def get_current_best_estimate(self):
@@ -197,11 +296,22 @@ class Deferred(BaseDeferred):
             return self
         return self.value
 
+    def is_ready(self):
+        return self.settled or self.ready_check is None or self.ready_check()
+
+    def settle(self, value):
+        # Overrides the value, e.g. with a placeholder when it cannot be computed
+        self.value = value
+        self.settled = True
+        self.fn = None
+
 
 Deferred.next_instance_id = 1
 
 
 class LinearPolynomial(BaseDeferred):
+    __slots__ = ("coeffs", "constant_term")
+
     def __init__(self, typ, coeffs=None, constant_term=0):
         if typ is not int:  # pragma: no cover
             raise TypeError(f"Can only instantiate LinearPolynomial[int], not LinearPolynomial[{typ.__name__}]")
@@ -229,6 +339,17 @@ class LinearPolynomial(BaseDeferred):
         if not isinstance(constant_term, int):  # pragma: no cover
             raise TypeError(f"LinearPolynomial constant term has an invalid type {type(constant_term).__name__}")
 
+    @classmethod
+    def from_coeffs(cls, coeffs, constant_term):
+        # For polynomials made from other ones: coeffs must be a dict of valid nonzero coefficients,
+        # which is used as is rather than checked and copied, so it must not be modified afterwards
+        poly = object.__new__(cls)
+        poly.typ = int
+        poly.is_awaiting = False
+        poly.coeffs = coeffs
+        poly.constant_term = constant_term
+        return poly
+
     def __repr__(self):
         lst = []
         for key, value in self.coeffs.items():
@@ -250,13 +371,23 @@ class LinearPolynomial(BaseDeferred):
         if isinstance(rhs, BaseDeferred):
             rhs = rhs.get_current_best_estimate()
         if not isinstance(rhs, BaseDeferred):
-            return LinearPolynomial[int](self.coeffs, self.constant_term + rhs)
-        if not isinstance(rhs, LinearPolynomial):
-            rhs = LinearPolynomial[int]({rhs: 1})
-        return LinearPolynomial[int](
-            list(self.coeffs.items()) + list(rhs.coeffs.items()),
-            self.constant_term + rhs.constant_term
-        )
+            return LinearPolynomial.from_coeffs(self.coeffs, self.constant_term + rhs)
+        if isinstance(rhs, Address):
+            rhs = rhs.to_polynomial()
+        if isinstance(rhs, LinearPolynomial):
+            terms = rhs.coeffs.items()
+            constant_term = self.constant_term + rhs.constant_term
+        else:
+            terms = ((rhs, 1),)
+            constant_term = self.constant_term
+        coeffs = dict(self.coeffs)
+        for key, value in terms:
+            value += coeffs.get(key, 0)
+            if value == 0:
+                del coeffs[key]
+            else:
+                coeffs[key] = value
+        return LinearPolynomial.from_coeffs(coeffs, constant_term)
 
     def __radd__(self, lhs):
         return self + lhs
@@ -269,37 +400,66 @@ class LinearPolynomial(BaseDeferred):
                 return Deferred[int](lambda: wait(self) * wait(rhs))
             else:
                 return rhs * self.constant_term
-        return LinearPolynomial[int]({key: value * rhs for key, value in self.coeffs.items()}, self.constant_term * rhs)
+        return self.scale(rhs)
 
     def __rmul__(self, lhs):
         assert isinstance(lhs, self.typ)
-        return LinearPolynomial[int]({key: value * lhs for key, value in self.coeffs.items()}, self.constant_term * lhs)
-
+        return self.scale(lhs)
 
     def __neg__(self):
-        return LinearPolynomial[int]({key: -value for key, value in self.coeffs.items()}, -self.constant_term)
+        return self.scale(-1)
+
+    def scale(self, factor):
+        if factor == 0:
+            return LinearPolynomial.from_coeffs({}, 0)
+        return LinearPolynomial.from_coeffs({key: value * factor for key, value in self.coeffs.items()}, self.constant_term * factor)
 
     def _wait(self):
-        new_coeffs = []
-        new_constant_term = self.constant_term
+        new_coeffs = {}
+        new_constant_term = 0
+        not_ready_keys = {}
+
+        # The variables of the values substituted may be known by now too, e.g. the link address
+        # may have been set. Those values may in turn refer to other values, so this is done with
+        # an explicit stack of the terms left to substitute, in order.
+        pending = [(iter(self.coeffs.items()), 1)]
+        while pending:
+            terms, factor = pending[-1]
+            for key, value in terms:
+                value *= factor
+                try:
+                    with try_compute:
+                        key = key.wait()
+                    if try_compute.failed:
+                        not_ready_keys[key] = try_compute.is_ready
+                except DeferredCycle:
+                    # The variable is being computed further up the stack, which is fine as long as
+                    # it cancels out
+                    pass
+                if isinstance(key, BaseDeferred):
+                    key = key.get_current_best_estimate()
+
+                if isinstance(key, LinearPolynomial):
+                    new_constant_term += key.constant_term * value
+                    pending.append((iter(key.coeffs.items()), value))
+                    break
+                elif isinstance(key, BaseDeferred):
+                    new_coeffs[key] = new_coeffs.get(key, 0) + value
+                else:
+                    new_constant_term += key * value
+            else:
+                pending.pop()
 
-        for key, value in self.coeffs.items():
-            with try_compute:
-                key = key.wait()
-            if isinstance(key, BaseDeferred):
-                key = key.get_current_best_estimate()
+        new_constant_term += self.constant_term
 
-            if isinstance(key, LinearPolynomial):
-                new_coeffs += [(key1, value1 * value) for key1, value1 in key.coeffs.items()]
-                new_constant_term += key.constant_term * value
-            elif isinstance(key, BaseDeferred):
-                new_coeffs.append((key, value))
-            else:
-                new_constant_term += key * value
+        self.coeffs = {key: value for key, value in new_coeffs.items() if value != 0}
+        self.constant_term = new_constant_term
 
-        new_value = LinearPolynomial[int](new_coeffs, new_constant_term)
-        self.coeffs = new_value.coeffs
-        self.constant_term = new_value.constant_term
+        # Waiting on a variable that has just turned out not to be ready would only find that out
+        # again, after computing everything it depends on once more
+        for key in self.coeffs:
+            if key in not_ready_keys:
+                not_ready(not_ready_keys[key])
 
         return sum(key.wait() * value for key, value in self.coeffs.items()) + self.constant_term
 
@@ -310,8 +470,209 @@ class LinearPolynomial(BaseDeferred):
             return self.constant_term
 
 
+def get_known_value(value):
+    if isinstance(value, BaseDeferred):
+        estimate = value.get_current_best_estimate()
+        if not isinstance(estimate, BaseDeferred):
+            return estimate
+    return value
+
+
+class Address(BaseDeferred):
+    # An address is a base, a constant offset and a few segments, the lengths of chunks emitted
+    # since the base that are not known yet. Adding a length to an address makes a sibling that
+    # shares its base: statically sized code only bumps the offset, so as soon as the base is known
+    # the address is a plain int. When there are too many segments, the address becomes the base
+    # of the next one instead. The chain ends with the root, usually the link address.
+    #
+    # The offset of every address from the root is computed at most once, from the offset of its
+    # base, so neither making an address nor waiting on or subtracting any of them walks all the
+    # code before it.
+    __slots__ = ("base", "offset", "segments", "root", "depth", "value", "settled", "known_offset_from_root", "deferred_offset_from_root")
+
+    MAX_SEGMENTS = 8
+
+    def __init__(self, typ, base, offset, segments):
+        if typ is not int:  # pragma: no cover
+            raise TypeError(f"Can only instantiate Address[int], not Address[{typ.__name__}]")
+        super().__init__(typ)
+        self.base = base
+        self.offset = offset
+        self.segments = segments
+        self.root = base.root if isinstance(base, Address) else base
+        self.depth = base.depth + 1 if isinstance(base, Address) else 1
+        self.value = None
+        self.settled = False
+        self.known_offset_from_root = None
+        self.deferred_offset_from_root = None
+
+    @classmethod
+    def construct(cls, typ, base, length=0):  # pylint: disable=arguments-differ
+        # Only known values are substituted: the link address in particular must stay a variable
+        # even when it is set to an expression, so that it cancels out
+        base = get_known_value(base)
+        length = get_known_value(length)
+
+        if isinstance(base, Address):
+            if isinstance(length, BaseDeferred) and len(base.segments) >= cls.MAX_SEGMENTS:
+                return cls(typ, base, 0, (length,))
+            offset = base.offset
+            segments = base.segments
+            base = get_known_value(base.base)
+        else:
+            offset = 0
+            segments = ()
+
+        if isinstance(length, BaseDeferred):
+            segments += (length,)
+        else:
+            offset += length
+
+        if not segments and not isinstance(base, BaseDeferred):
+            return base + offset
+        return cls(typ, base, offset, segments)
+
+    def __repr__(self):
+        if self.settled:
+            return repr(self.value)
+        base = f"@{self.depth - 1}" if isinstance(self.base, Address) else repr(self.base)
+        return "+".join([base, str(self.offset)] + [f"({segment!r})" for segment in self.segments])
+
+    # Anything but moving an address by a constant or subtracting two addresses is done on a
+    # polynomial, so that e.g. the link address cancels out the way it always did
+
+    def __add__(self, rhs):
+        if isinstance(rhs, int):
+            return Address[int](self, rhs)
+        return self.to_polynomial() + rhs
+
+    def __radd__(self, lhs):
+        return self + lhs
+
+    def __sub__(self, rhs):
+        if isinstance(rhs, int):
+            return Address[int](self, -rhs)
+        if isinstance(rhs, Address):
+            difference = self.get_difference(rhs)
+            if difference is not None:
+                return difference
+            rhs = rhs.to_polynomial()
+        return self.to_polynomial() - rhs
+
+    def __rsub__(self, lhs):
+        return lhs - self.to_polynomial()
+
+    def __neg__(self):
+        return -self.to_polynomial()
+
+    def __mul__(self, rhs):
+        return self.to_polynomial() * rhs
+
+    def __rmul__(self, lhs):
+        return lhs * self.to_polynomial()
+
+    def to_polynomial(self):
+        if self.settled:
+            return LinearPolynomial[int]({}, self.value)
+        coeffs = []
+        constant_term = 0
+        for term in (self.root, self.get_offset_from_root()):
+            if isinstance(term, LinearPolynomial):
+                coeffs += term.coeffs.items()
+                constant_term += term.constant_term
+            elif isinstance(term, BaseDeferred):
+                coeffs.append((term, 1))
+            else:
+                constant_term += term
+        return LinearPolynomial[int](coeffs, constant_term)
+
+    def get_difference(self, other):
+        # Returns None unless the two addresses have the same root, which then cancels out
+        if self.root is not other.root and (isinstance(self.root, BaseDeferred) or isinstance(other.root, BaseDeferred)):
+            return None
+        root_difference = 0 if self.root is other.root else self.root - other.root
+
+        # Whatever comes before the closest address both are made from cancels out, and the
+        # difference is a polynomial over the lengths on the way to it that are not known yet, so
+        # e.g. the distance between two labels is known as soon as the code between them is
+        # compiled. If the addresses are too far apart, each of them is instead taken relative to
+        # the root, as that is computed just once for every address.
+        coeffs = []
+        constant_term = root_difference
+        lhs, rhs = self, other
+        steps_left = self.MAX_SEGMENTS
+        while lhs is not rhs:
+            if isinstance(lhs, Address) and isinstance(rhs, Address) and lhs.base is rhs.base:
+                common = 0
+                while common < min(len(lhs.segments), len(rhs.segments)) and lhs.segments[common] is rhs.segments[common]:
+                    common += 1
+                steps = [(lhs.offset, lhs.segments[common:], 1), (rhs.offset, rhs.segments[common:], -1)]
+                lhs = rhs
+            else:
+                lhs_depth = lhs.depth if isinstance(lhs, Address) else 0
+                rhs_depth = rhs.depth if isinstance(rhs, Address) else 0
+                if lhs_depth == rhs_depth == 0:
+                    break
+                if lhs_depth >= rhs_depth:
+                    steps = [(lhs.offset, lhs.segments, 1)]
+                    lhs = lhs.base
+                else:
+                    steps = [(rhs.offset, rhs.segments, -1)]
+                    rhs = rhs.base
+
+            for offset, segments, sign in steps:
+                constant_term += offset * sign
+                for segment in segments:
+                    length = get_known_value(segment)
+                    if isinstance(length, LinearPolynomial):
+                        coeffs += [(key, value * sign) for key, value in length.coeffs.items()]
+                        constant_term += length.constant_term * sign
+                    elif isinstance(length, BaseDeferred):
+                        coeffs.append((length, sign))
+                    else:
+                        constant_term += length * sign
+            steps_left -= 1
+            if steps_left < 0 or len(coeffs) > self.MAX_SEGMENTS:
+                return self.get_offset_from_root() - other.get_offset_from_root() + root_difference
+
+        return LinearPolynomial[int](coeffs, constant_term).get_current_best_estimate()
+
+    def get_offset_from_root(self):
+        if self.known_offset_from_root is not None:
+            return self.known_offset_from_root
+        if self.deferred_offset_from_root is None:
+            self.deferred_offset_from_root = Deferred[int](self.compute_offset_from_root)
+        return get_known_value(self.deferred_offset_from_root)
+
+    def compute_offset_from_root(self):
+        # Every address on the way to the closest one whose offset is known is handled oldest
+        # first, so that the offsets of all labels take linear time to compute in total
+        chain = []
+        addr = self
+        while isinstance(addr, Address) and addr.known_offset_from_root is None:
+            chain.append(addr)
+            addr = addr.base
+        offset = addr.known_offset_from_root if isinstance(addr, Address) else 0
+        for addr in reversed(chain):
+            offset += addr.offset + sum(wait(segment) for segment in addr.segments)
+            addr.known_offset_from_root = offset
+        return offset
+
+    def _wait(self):
+        if not self.settled:
+            self.value = wait(self.root) + self.compute_offset_from_root()
+            self.settled = True
+        return self.value
+
+    def get_current_best_estimate(self):
+        if self.settled:
+            return self.value
+        return self
+
 
 class Concatenator(BaseDeferred):
+    __slots__ = ("lst",)
+
     def __init__(self, typ, lst):
         super().__init__(typ)
         self.lst = lst
@@ -360,7 +721,102 @@ class Concatenator(BaseDeferred):
         return Concatenator[self.typ]([lhs] + self.lst)
 
 
+class Rope(BaseDeferred):
+    # Code being emitted, as a list of chunks, some of which may be deferred. Unlike adding bytes or
+    # a Concatenator, appending doesn't copy anything, and the length is kept up to date instead of
+    # being summed over all chunks. The chunks are joined only once, when the rope is waited on;
+    # bytes.join sizes the result in advance and copies each chunk into it exactly once.
+    __slots__ = ("chunks", "static_length", "deferred_lengths", "waited")
+
+    def __init__(self, typ):
+        if typ is not bytes:  # pragma: no cover
+            raise TypeError(f"Can only instantiate Rope[bytes], not Rope[{typ.__name__}]")
+        super().__init__(typ)
+        self.chunks = []
+        self.static_length = 0
+        self.deferred_lengths = []
+        # Chunks before this index are known not to be deferred
+        self.waited = 0
+
+    def __repr__(self):
+        return "+".join(map(repr, self.chunks)) or "b''"
+
+    def append(self, chunk):
+        if isinstance(chunk, Rope):
+            # Nested ropes are spliced rather than joined, so that every byte is copied just once
+            self.chunks += chunk.chunks
+            self.static_length += chunk.static_length
+            self.deferred_lengths += chunk.deferred_lengths
+        elif isinstance(chunk, BaseDeferred):
+            self.chunks.append(chunk)
+            length = chunk.length()
+            if isinstance(length, BaseDeferred):
+                self.deferred_lengths.append(length)
+            else:
+                self.static_length += length
+        elif chunk:
+            self.chunks.append(chunk)
+            self.static_length += len(chunk)
+
+    def reserve(self, length):
+        # Makes room for a chunk of a known length that is only compiled later. The hole stays
+        # valid when the rope is spliced into another one
+        hole = Hole()
+        self.chunks.append(hole)
+        self.static_length += length
+        return hole
+
+    def length(self):
+        if not self.deferred_lengths:
+            return self.static_length
+        coeffs = []
+        constant_term = self.static_length
+        for length in self.deferred_lengths:
+            if isinstance(length, LinearPolynomial):
+                coeffs += length.coeffs.items()
+                constant_term += length.constant_term
+            else:
+                coeffs.append((length, 1))
+        return LinearPolynomial[int](coeffs, constant_term)
+
+    def _wait(self):
+        # Computed chunks are stored back, so that a restarted wait doesn't wait on them again
+        chunks = self.chunks
+        while self.waited < len(chunks):
+            chunk = chunks[self.waited]
+            if isinstance(chunk, Hole):
+                chunk = chunk.chunk
+            chunks[self.waited] = wait(chunk)
+            self.waited += 1
+        # Chunks may be views into other buffers, which are copied only here
+        if len(chunks) > 1 or (chunks and not isinstance(chunks[0], self.typ)):
+            chunks[:] = [self.typ().join(chunks)]
+            self.waited = 1
+        return chunks[0] if chunks else self.typ()
+
+    def get_current_best_estimate(self):
+        while self.waited < len(self.chunks):
+            chunk = self.chunks[self.waited]
+            if isinstance(chunk, Hole):
+                chunk = chunk.chunk
+            if chunk is None or isinstance(chunk, BaseDeferred):
+                return self
+            self.chunks[self.waited] = chunk
+            self.waited += 1
+        return self._wait()
+
+
+class Hole:
+    # A chunk reserved in a Rope, filled in later
+    __slots__ = ("chunk",)
+
+    def __init__(self):
+        self.chunk = None
+
+
 class SizedDeferred(Deferred):
+    __slots__ = ("size",)
+
     def __init__(self, typ, size, fn):
         super().__init__(typ, fn)
         self.size = size
@@ -368,6 +824,8 @@ class SizedDeferred(Deferred):
     @classmethod
     def construct(cls, typ, size, fn):  # pylint: disable=arguments-differ
         tmp = cls(typ, size, fn)
+        if put_off.depth > 0:
+            return tmp
         with try_compute:
             return tmp.wait()
         return tmp
@@ -380,6 +838,8 @@ class SizedDeferred(Deferred):
 
 
 class Promise(BaseDeferred):
+    __slots__ = ("name", "value", "settled")
+
     def __init__(self, typ, name):
         super().__init__(typ)
         self.name = name
@@ -396,7 +856,7 @@ class Promise(BaseDeferred):
 
     def _wait(self):
         if not self.settled:
-            not_ready()
+            not_ready(lambda: self.settled)
             raise Exception(f"Promise {self!r} is not ready")  # pragma: no cover
         return self.value
 
@@ -33,6 +33,17 @@ REGISTER_NAMES = {
     "pc": 7
 }
 
+def is_register(operand):
+    return (
+        (isinstance(operand, Symbol) and not operand.is_necessarily_label and operand.name.lower() in REGISTER_NAMES)
+        or isinstance(operand, operators.register)
+    )
+
+
+def is_register_in_parentheses(operand):
+    return isinstance(operand, ParenthesizedExpression) and operand.opening_parenthesis == "(" and is_register(operand.expr)
+
+
 def try_as_register(operand, state):
     if isinstance(operand, Symbol) and not operand.is_necessarily_label and operand.name.lower() in REGISTER_NAMES:
         return REGISTER_NAMES[operand.name.lower()]
@@ -63,6 +74,9 @@ class RegisterOperandStub:
         )
         raise reports.RecoverableError("Register expected, expression passed")
 
+    def get_size(self, operand):
+        return 0 if is_register(operand) else None
+
 
 class RegisterModeOperandStub:
     def __init__(self, pattern_char, bit_indexes):
@@ -178,6 +192,20 @@ class RegisterModeOperandStub:
         # Relative
         return 0o67, SizedDeferred[bytes](2, lambda: struct.pack("<H", wait(operand.resolve(state) - state["rel_address"] - 2) % (2 ** 16)))
 
+    def get_size(self, operand):
+        # Only the modes that use nothing but a register don't take an extra word. There's no need
+        # to hoist: that only turns what would be relative addressing into index addressing, and
+        # both take a word
+        if isinstance(operand, operators.deferred):
+            if is_register(operand.operand):
+                return 0
+            operand = operand.operand
+        elif is_register(operand) or is_register_in_parentheses(operand):
+            return 0
+        if isinstance(operand, (operators.postadd, operators.neg)) and is_register_in_parentheses(operand.operand):
+            return 0
+        return 2
+
 
 class FP11RMOperandStub(RegisterModeOperandStub):
     def encode(self, operand, state):
@@ -200,6 +228,11 @@ class FP11RMOperandStub(RegisterModeOperandStub):
 
         return super().encode(operand, state)
 
+    def get_size(self, operand):
+        if try_accumulator_from_symbol(operand) is not None:
+            return 0
+        return super().get_size(operand)
+
 
 class OffsetOperandStub:
     def __init__(self, pattern_char, bit_indexes, unsigned):
@@ -288,6 +321,10 @@ class OffsetOperandStub:
         return Deferred[int](fn), b""
 
 
+    def get_size(self, operand):  # pylint: disable=unused-argument
+        return 0
+
+
 
 class ImmediateOperandStub:
     def __init__(self, pattern_char, bit_indexes, unsigned):
@@ -330,6 +367,10 @@ class ImmediateOperandStub:
         return Deferred[int](fn), b""
 
 
+    def get_size(self, operand):  # pylint: disable=unused-argument
+        return 0
+
+
 
 class FP11AccumulatorOperandStub:
     def __init__(self, pattern_char, bit_indexes):
@@ -350,6 +391,9 @@ class FP11AccumulatorOperandStub:
 
         return acc, b""
 
+    def get_size(self, operand):
+        return 0 if try_accumulator_from_symbol(operand) is not None else None
+
 
 class Instruction:
     def __init__(self, name, opcode_pattern, operands):
@@ -403,6 +447,20 @@ class Instruction:
         return SizedDeferred[bytes](2, get_opcode) + operands_encoding
 
 
+    def get_size(self, insn):
+        # The size is determined by the addressing modes alone, so it is known before the operands
+        # can be computed. None if the instruction is invalid and will report an error instead
+        if len(insn.operands) != len(self.operands):
+            return None
+        size = 2
+        for stub, operand_expr in zip(self.operands, insn.operands):
+            operand_size = stub.get_size(operand_expr)
+            if operand_size is None:
+                return None
+            size += operand_size
+        return size
+
+
 
 
 instructions = CaseInsensitiveDict()
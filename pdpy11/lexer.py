@@ -0,0 +1,115 @@
+import re
+
+
+# Macro-11 syntax is too context-dependent for a classic lexer: '/' is both an
+# operator and a string quote, ';' starts a comment everywhere except inside
+# strings, and so on. So instead of producing a token stream the parser must
+# blindly follow, the lexer splits the source into whitespace runs, words and
+# single characters once, and the parser looks tokens up by position. Words are
+# what symbols, labels, numbers and instruction names are made of.
+
+WHITESPACE = 0
+WORD = 1
+CHARACTER = 2
+
+token_regex = re.compile(r"((?:\s|;[^\n]*)+)|([a-z_0-9$.]+)|[\s\S]", flags=re.I)
+
+# Matches the empty string too, so skipping whitespace is a single match() call that never fails
+whitespace_regex = re.compile(r"(?:\s|;[^\n]*)*")
+
+word_regex = re.compile(r"[a-z_0-9$.]+", flags=re.I)
+symbol_regex = re.compile(r"[a-z_$][a-z_0-9$.]*", flags=re.I)
+local_symbol_regex = re.compile(r"\d[a-z_0-9$.]*", flags=re.I)
+instruction_name_regex = re.compile(r"\.?[a-z_][a-z_0-9]*", flags=re.I)
+
+
+class Lexer:
+    # Only the part of code from start to the first token boundary at or after stop is tokenized.
+    # Every lookup outside of it falls back to matching regexes right away, which is slower but
+    # gives the same results.
+
+    def __init__(self, code, start=0, stop=None):
+        self.code = code
+        self.kinds = []
+        self.starts = []
+        self.ends = []
+        self.folded = []
+        self.index_by_start = {}
+        self.instruction_name_ends = {}
+
+        self.end = start
+        for match in token_regex.finditer(code, start):
+            start, end = match.span()
+            if stop is not None and start >= stop:
+                break
+            self.end = end
+            self.index_by_start[start] = len(self.kinds)
+            self.starts.append(start)
+            self.ends.append(end)
+            if match.start(1) != -1:
+                self.kinds.append(WHITESPACE)
+                self.folded.append(None)
+            elif match.start(2) != -1:
+                self.kinds.append(WORD)
+                self.folded.append(match.group().lower())
+            else:
+                self.kinds.append(CHARACTER)
+                self.folded.append(None)
+
+
+    def whitespace_end(self, pos):
+        # Returns the position after the whitespace run starting at pos, or -1 if pos is not the
+        # start of a token, in which case the caller has to skip whitespace by itself
+        index = self.index_by_start.get(pos)
+        if index is None:
+            return -1
+        elif self.kinds[index] == WHITESPACE:
+            return self.ends[index]
+        else:
+            return pos
+
+
+    def match_word(self, pos):
+        index = self.index_by_start.get(pos)
+        if index is None:
+            # Somewhere in the middle of a token, e.g. right after an instruction name that stopped
+            # at a dollar sign. Rare enough not to bother with caching.
+            match = word_regex.match(self.code, pos)
+            return -1 if match is None else match.end()
+        elif self.kinds[index] == WORD:
+            return self.ends[index]
+        else:
+            return -1
+
+
+    def match_symbol(self, pos):
+        end = self.match_word(pos)
+        if end == -1 or not symbol_regex.match(self.code, pos, pos + 1):
+            return -1
+        return end
+
+
+    def match_local_symbol(self, pos):
+        end = self.match_word(pos)
+        if end == -1 or not local_symbol_regex.match(self.code, pos, pos + 1):
+            return -1
+        return end
+
+
+    def match_instruction_name(self, pos):
+        end = self.instruction_name_ends.get(pos)
+        if end is None:
+            if self.match_word(pos) == -1:
+                end = -1
+            else:
+                match = instruction_name_regex.match(self.code, pos)
+                end = -1 if match is None else match.end()
+            self.instruction_name_ends[pos] = end
+        return end
+
+
+    def folded_text(self, start, end):
+        index = self.index_by_start.get(start)
+        if index is not None and self.ends[index] == end and self.kinds[index] == WORD:
+            return self.folded[index]
+        return self.code[start:end].lower()
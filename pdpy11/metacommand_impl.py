@@ -106,9 +106,10 @@ else:
 
 
 class Metacommand:
-    def __init__(self, fn, name, size=None, literal_string_operand=False, raw=False):
+    def __init__(self, fn, name, size=None, literal_string_operand=False, raw=False, pure=False):
         self.fn = fn
         self.size = size
+        self.pure = pure
         self.literal_string_operand = literal_string_operand
         self.name = name
         self.raw = raw
@@ -147,6 +148,14 @@ class Metacommand:
             assert 0 <= self.min_operands <= 1 and self.max_operands == 1, "A metacommand with a literal string operand is expected to have exactly one operand (optional or not)"
 
 
+    def get_size(self, insn):
+        # Metacommands may have side effects, so only pure ones can be compiled out of order. Their
+        # size depends on the operands alone
+        if not self.pure:
+            return None
+        return self.size(None, *insn.operands) if callable(self.size) else self.size
+
+
     def compile_insn(self, state, insn):
         insn_operands = insn.operands
         code_block = None
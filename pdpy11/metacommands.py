@@ -1,6 +1,7 @@
+import os
 import struct
 
-from .deferred import wait, BaseDeferred
+from .deferred import wait, Address, Rope
 from . import devices
 from . import radix50
 from . import reports
@@ -10,7 +11,7 @@ from .types import CodeBlock
 from .metacommand_impl import metacommand, get_as_int, get_as_str, int8, int16, int32, uint, uint16
 
 
-@metacommand(size=lambda state, *operands: len(operands) or 1, alias=".db")
+@metacommand(size=lambda state, *operands: len(operands) or 1, alias=".db", pure=True)
 def byte(state, *byte_operand: int8) -> bytes:
     if not byte_operand:
         reports.warning(
@@ -21,7 +22,7 @@ def byte(state, *byte_operand: int8) -> bytes:
     return b"".join(struct.pack("<B", operand) for operand in byte_operand)
 
 
-@metacommand(size=lambda state, *operands: 2 * (len(operands) or 1), alias=".dw")
+@metacommand(size=lambda state, *operands: 2 * (len(operands) or 1), alias=".dw", pure=True)
 def word(state, *word_operand: int16) -> bytes:
     prefix = b""
     if wait(state["emit_address"]) % 2 == 1:
@@ -39,7 +40,7 @@ def word(state, *word_operand: int16) -> bytes:
     return prefix + b"".join(struct.pack("<H", operand) for operand in word_operand)
 
 
-@metacommand(size=lambda state, *operands: 4 * (len(operands) or 1))
+@metacommand(size=lambda state, *operands: 4 * (len(operands) or 1), pure=True)
 def dword(state, *dword_operand: int32) -> bytes:
     prefix = b""
     if wait(state["emit_address"]) % 2 == 1:
@@ -166,14 +167,11 @@ def align(state, count: uint) -> bytes:
 @metacommand
 def repeat(state, repetitions_count: uint, body: CodeBlock) -> bytes:
     addr = state["emit_address"]
-    result = b""
+    result = Rope[bytes]()
     for _ in range(repetitions_count):
         chunk = state["compiler"].compile_block({**state, "context": "repeat"}, body, addr)
-        if isinstance(chunk, BaseDeferred):
-            addr += chunk.length()
-        else:
-            addr += len(chunk)
-        result += chunk
+        addr = Address[int](addr, chunk.length())
+        result.append(chunk)
     return result
 
 
@@ -246,12 +244,45 @@ def page(state) -> bytes:
     return b""
 
 
+def get_insertion_range(state, include_path, size, offset, length):
+    start = 0 if offset is None else offset
+    if start > size:
+        reports.error(
+            "value-out-of-bounds",
+            (state["insn"].ctx_start, state["insn"].ctx_end, f"Offset {start} is past the end of file '{include_path}', which is {size} bytes long.")
+        )
+        raise reports.RecoverableError("Offset out of bounds")
+
+    stop = size if length is None else start + length
+    if stop > size:
+        reports.error(
+            "value-out-of-bounds",
+            (state["insn"].ctx_start, state["insn"].ctx_end, f"{length} bytes starting from offset {start} were requested, but file '{include_path}' is only {size} bytes long.")
+        )
+        raise reports.RecoverableError("Length out of bounds")
+
+    return start, stop
+
+
 @metacommand(no_dot=True)
-def insert_file(state, inserted_file_path: str) -> bytes:
+def insert_file(state, inserted_file_path: str, offset: uint=None, length: uint=None) -> bytes:
     include_path = devices.resolve_relative_path(inserted_file_path, state["filename"])
+
+    data = state["compiler"].prefetched_insertions.get(include_path)
+    if data is not None:
+        start, stop = get_insertion_range(state, include_path, len(data), offset, length)
+        # A view rather than a slice, so that the bytes are only copied when the code is joined
+        return data if (start, stop) == (0, len(data)) else memoryview(data)[start:stop]
+
     try:
         with open(include_path, "rb") as f:
-            return f.read()
+            if offset is None and length is None:
+                return f.read()
+            # Only read the requested part, so that a small piece of a large blob is cheap to insert
+            size = os.fstat(f.fileno()).st_size
+            start, stop = get_insertion_range(state, include_path, size, offset, length)
+            f.seek(start)
+            return f.read(stop - start)
     except FileNotFoundError:
         reports.error(
             "io-error",
@@ -358,8 +389,17 @@ def link(state, address: int) -> bytes:
 def include(state, included_file_path: str):
     include_path = devices.resolve_relative_path(included_file_path, state["filename"])
 
+    if state["compiler"].is_included_once(include_path):
+        return b""
+
+    file_ast = state["compiler"].take_prefetched_include(include_path)
+    if file_ast is None:
+        file_ast = state["compiler"].load_include(include_path)
+    if file_ast is not None:
+        return state["compiler"].compile_include(file_ast, state["emit_address"])
+
     try:
-        with open(include_path, "r") as f:
+        with open(include_path, "r", encoding="utf-8") as f:
             code = f.read()
     except FileNotFoundError:
         reports.error(
@@ -386,10 +426,7 @@ def include(state, included_file_path: str):
         )
         return b""
 
-    # parser needs to have a list of metacommands. This avoids cyclic dependency.
-    # pylint: disable=import-outside-toplevel
-    from . import parser
-    file_ast = parser.parse(include_path, code)
+    file_ast = state["compiler"].parse_include(include_path, code)
 
     code = state["compiler"].compile_include(file_ast, state["emit_address"])
 
@@ -14,12 +14,14 @@ def wrap_impure(expr, invoke):
 
 
 class InfixOperator(ExpressionToken):
-    fn: ...
-    char: str
-    awaited: bool
-    token: bool
-    pure: bool
-    return_type: type
+    __slots__ = ("lhs", "rhs", "value")
+
+    fn: typing.ClassVar[typing.Callable]
+    char: typing.ClassVar[str]
+    awaited: typing.ClassVar[bool]
+    token: typing.ClassVar[bool]
+    pure: typing.ClassVar[bool]
+    return_type: typing.ClassVar[type]
 
     def __init__(self, ctx_start, ctx_end, lhs: ExpressionToken, rhs: ExpressionToken):
         super().__init__(ctx_start, ctx_end)
@@ -55,12 +57,14 @@ class InfixOperator(ExpressionToken):
         return f"{self.lhs!r} {self.char} {self.rhs!r}"
 
 class UnaryOperator(ExpressionToken):
-    fn: ...
-    char: str
-    awaited: bool
-    token: bool
-    pure: bool
-    return_type: type
+    __slots__ = ("operand", "value")
+
+    fn: typing.ClassVar[typing.Callable]
+    char: typing.ClassVar[str]
+    awaited: typing.ClassVar[bool]
+    token: typing.ClassVar[bool]
+    pure: typing.ClassVar[bool]
+    return_type: typing.ClassVar[type]
 
     def __init__(self, ctx_start, ctx_end, operand: ExpressionToken):
         super().__init__(ctx_start, ctx_end)
@@ -89,11 +93,15 @@ class UnaryOperator(ExpressionToken):
 
 
 class PrefixOperator(UnaryOperator):
+    __slots__ = ()
+
     def __repr__(self):
         return f"{self.char}{self.operand!r}"
 
 
 class PostfixOperator(UnaryOperator):
+    __slots__ = ()
+
     def __repr__(self):
         return f"{self.operand!r}{self.char}"
 
@@ -126,7 +134,7 @@ def operator(signature, precedence, associativity, awaited=True, pure=True, toke
     assert char, "Operator must not be empty"
 
     class Class(kind):
-        pass
+        __slots__ = ()
     Class.precedence = precedence
     Class.associativity = associativity
     Class.char = char
@@ -138,6 +146,7 @@ def operator(signature, precedence, associativity, awaited=True, pure=True, toke
     def decorator(fn):
         Class.fn = fn
         Class.__name__ = fn.__name__
+        Class.__qualname__ = fn.__name__
         Class.return_type = typing.get_type_hints(fn).get("return")
         return Class
 
@@ -0,0 +1,133 @@
+import concurrent.futures
+import itertools
+
+from . import devices
+from . import parser
+from . import reports
+from . import types
+
+
+def parse_recording_reports(filename, code, ast_cache=None):
+    recorded = []
+
+    def report_handler(priority, identifier, *lst_reports):
+        # The parser passes its own context around and keeps moving it, so the positions have to be
+        # taken now rather than when the reports are replayed
+        recorded.append((priority, identifier, [(start.at(start.pos), end.at(end.pos), text) for start, end, text in lst_reports]))
+
+    file = None
+    try:
+        with reports.handle_reports(report_handler):
+            if ast_cache is None:
+                file = parser.parse(filename, code)
+            else:
+                file = ast_cache.parse(filename, code)
+    except reports.UnrecoverableError:
+        # Either a critical error, in which case there is no AST, or a plain one, which the caller
+        # will find out about when the reports are replayed
+        pass
+
+    return file, recorded
+
+
+def parse_files(files, jobs, ast_cache=None):
+    # Parses (filename, code) pairs in a process pool. Workers send the ASTs back pickled along with
+    # the reports they emitted, and the reports are replayed in input order, so the diagnostics
+    # are the same as if the files were parsed one after another.
+    filenames = [filename for filename, _ in files]
+    codes = [code for _, code in files]
+
+    parsed_files = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for file, recorded in executor.map(parse_recording_reports, filenames, codes, itertools.repeat(ast_cache)):
+            for priority, identifier, lst_reports in recorded:
+                priority(identifier, *lst_reports)
+            parsed_files.append(file)
+
+    return parsed_files
+
+
+def read_and_parse(path, ast_cache=None):
+    # Errors are left for the .include metacommand to report when it is reached
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            code = f.read()
+    except (IOError, UnicodeDecodeError):
+        return None
+    return parse_recording_reports(path, code, ast_cache)
+
+
+def read_binary(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def find_include_targets(block, filename):
+    # Yields ("include" or "insert_file", path) for every file the block refers to by a literal path.
+    # Paths computed at compile time can't be known in advance and are simply not prefetched.
+    for insn in block.insns:
+        if not isinstance(insn, types.Instruction):
+            continue
+
+        name = insn.name.name.lower()
+        if name in ("include", ".include"):
+            kind = "include"
+        elif name == "insert_file":
+            kind = "insert_file"
+        else:
+            kind = None
+
+        # insert_file may also be given the range to insert, which doesn't matter for reading the file
+        if kind is not None and insn.operands and isinstance(insn.operands[0], types.QuotedString):
+            yield kind, devices.resolve_relative_path(insn.operands[0].string, filename)
+
+        for operand in insn.operands:
+            if isinstance(operand, types.CodeBlock):
+                yield from find_include_targets(operand, filename)
+
+
+def prefetch_includes(files, jobs, ast_cache=None):
+    # Follows .include and insert_file recursively, starting from the given parsed files. Included
+    # sources are read and parsed in a process pool and binary files are read in a thread pool, so
+    # that compilation finds them ready. Returns two dicts, from path to the result of
+    # read_and_parse and from path to the contents of the binary file. Files that could not be read
+    # are left out.
+    includes = {}
+    insertions = {}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as processes, concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as threads:
+        pending = {}
+        seen = set()
+
+        def visit(file):
+            for kind, path in find_include_targets(file.body, file.filename):
+                if (kind, path) in seen:
+                    continue
+                seen.add((kind, path))
+                if kind == "include":
+                    pending[processes.submit(read_and_parse, path, ast_cache)] = (kind, path)
+                else:
+                    pending[threads.submit(read_binary, path)] = (kind, path)
+
+        for file in files:
+            visit(file)
+
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                kind, path = pending.pop(future)
+                result = future.result()
+                if result is None:
+                    continue
+                if kind == "include":
+                    includes[path] = result
+                    file, _ = result
+                    if file is not None:
+                        visit(file)
+                else:
+                    insertions[path] = result
+
+    return includes, insertions
@@ -1,7 +1,8 @@
 import re
 
 from .builtins import builtin_commands
-from .context import Context
+from .context import Context, Source
+from .lexer import Lexer
 from .metacommand_impl import Metacommand
 from . import operators
 from . import radix50
@@ -20,9 +21,64 @@ goto = Goto()
 REGISTER_NAMES = ("r0", "r1", "r2", "r3", "r4", "r5", "r6", "r7", "sp", "pc")
 
 
+class Fail:
+    def __repr__(self):
+        return "FAIL"
+
+# Parser functions may return this instead of raising RecoverableError. Failed optional matches are
+# the common case, and raising and catching an exception for each of them is not cheap. An exception
+# is only raised when the caller did not ask for an optional match.
+FAIL = Fail()
+
+
+class Memo:
+    # Packrat-style memo table. Named grammar rules, i.e. those defined via @Parser, run at most once
+    # per position and set of arguments; backtracking into another alternative reuses the result
+    # (or the failure) instead of parsing the same text again. Sub-parses that emitted reports are
+    # not remembered, because reusing them would swallow the diagnostics.
+    #
+    # Opt-in via parse(..., memo=Memo()). The table only lives for one file, the counters add up
+    # over all files parsed with the same object.
+    def __init__(self):
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+
+    def __call__(self, parser, ctx, kwargs):
+        key = (parser, ctx.pos, tuple(kwargs.items()))
+
+        entry = self.table.get(key)
+        if entry is not None:
+            self.hits += 1
+            result, ctx.pos = entry
+            return FAIL if result is None else result
+
+        self.misses += 1
+        emitted_count = reports.emitted_count
+        try:
+            result = parser.fn(ctx, **kwargs)
+        except reports.RecoverableError:
+            if reports.emitted_count == emitted_count:
+                self.table[key] = (None, ctx.pos)
+            raise
+        if reports.emitted_count == emitted_count:
+            self.table[key] = (None if result is FAIL else result, ctx.pos)
+        return result
+
+
 class Parser:
-    def __init__(self, fn):
+    def __init__(self, fn, memoize=True, failure=None):
         self.fn = fn
+        self.memoize = memoize
+        # The message of the exception raised when fn returns FAIL to a caller that did not pass
+        # maybe=True
+        self.failure = failure or f"Failed to match {getattr(fn, '__name__', 'parser')} at position {{pos}}"
 
 
     @classmethod
@@ -32,8 +88,8 @@ class Parser:
                 result = parser(ctx, **kwargs, maybe=True)
                 if result is not None:
                     return result
-            raise reports.RecoverableError("Failed to match either of the alternatives")
-        return cls(fn)
+            return FAIL
+        return cls(fn, memoize=False, failure="Failed to match either of the alternatives")
 
 
     def __or__(self, rhs):
@@ -42,23 +98,32 @@ class Parser:
             result = self(ctx, **kwargs, maybe=True)
             if result is not None:
                 return result
-            return rhs(ctx, **kwargs)
-        return Parser(fn)
+            result = rhs(ctx, **kwargs, maybe=True)
+            if result is not None:
+                return result
+            return FAIL
+        return Parser(fn, memoize=False, failure="Failed to match either of the alternatives")
 
 
     def __add__(self, rhs):
         assert isinstance(rhs, Parser)
         def fn(ctx):
-            return self(ctx) + rhs(ctx)
-        return Parser(fn)
+            lhs_result = self(ctx, maybe=True)
+            if lhs_result is None:
+                return FAIL
+            rhs_result = rhs(ctx, maybe=True)
+            if rhs_result is None:
+                return FAIL
+            return lhs_result + rhs_result
+        return Parser(fn, memoize=False, failure="Failed to match a sequence at position {pos}")
 
 
     def __invert__(self):
         def fn(ctx):
             if self(ctx, maybe=True):
-                raise reports.RecoverableError("An unexpected match happened")
+                return FAIL
             return ""
-        return Parser(fn)
+        return Parser(fn, memoize=False, failure="An unexpected match happened")
 
 
     # def __rshift__(self, rhs):
@@ -74,28 +139,31 @@ class Parser:
         if lookahead:
             assert maybe
         if maybe:
-            old_ctx = ctx.save()
-            try:
+            old_pos = ctx.pos
+        try:
+            if self.memoize and ctx.source.memo is not None:
+                result = ctx.source.memo(self, ctx, kwargs)
+            else:
                 result = self.fn(ctx, **kwargs)
-                assert result is not None
-            except reports.RecoverableError:
-                ctx.restore(old_ctx)
+            assert result is not None
+        except reports.RecoverableError:
+            if not maybe and report is None:
+                raise
+            result = FAIL
+        if result is FAIL:
+            if maybe:
+                ctx.pos = old_pos
                 return None
+            elif report is None:
+                raise reports.RecoverableError(self.failure.format(pos=ctx.pos))
             else:
-                if lookahead:
-                    ctx.restore(old_ctx)
-                return result
-        else:
-            try:
-                result = self.fn(ctx, **kwargs)
-                assert result is not None
-                return result
-            except reports.RecoverableError:
-                if report is None:
-                    raise
-                else:
-                    reports.emit_report(*report)
-                    return None
+                # Reports that need to build contexts are passed as a function so that the contexts
+                # are only built on failure
+                reports.emit_report(*(report() if callable(report) else report))
+                return None
+        if lookahead:
+            ctx.pos = old_pos
+        return result
 
 
     @classmethod
@@ -106,10 +174,26 @@ class Parser:
                 ctx.skip_whitespace()
             match = regex.match(ctx.code, ctx.pos)
             if match is None:
-                raise reports.RecoverableError(f"Failed to match regex at position {ctx.pos}")
+                return FAIL
             ctx.pos = match.end()
             return match.group()
-        return Parser(fn)
+        return Parser(fn, memoize=False, failure="Failed to match regex at position {pos}")
+
+
+    @classmethod
+    def token(cls, match, skip_whitespace_before=True):
+        # 'match' is one of Lexer.match_* methods, which look the token up in the per-file token
+        # table instead of matching the source again
+        def fn(ctx):
+            if skip_whitespace_before:
+                ctx.skip_whitespace()
+            end = match(ctx.source.lexer, ctx.pos)
+            if end == -1:
+                return FAIL
+            start = ctx.pos
+            ctx.pos = end
+            return ctx.code[start:end]
+        return Parser(fn, memoize=False, failure="Failed to match token at position {pos}")
 
 
     @classmethod
@@ -119,26 +203,24 @@ class Parser:
         def fn(ctx):
             if skip_whitespace_before:
                 ctx.skip_whitespace()
-            found = ctx.code[ctx.pos:ctx.pos + len(literal)]
-            check_found = found if case_sensitive else found.lower()
-            if check_found == literal:
+            text = ctx.code if case_sensitive else ctx.source.folded_code
+            if text.startswith(literal, ctx.pos):
                 ctx.pos += len(literal)
                 return literal
             else:
-                raise reports.RecoverableError(f"Failed to match literal at position {ctx.pos}")
-        return Parser(fn)
+                return FAIL
+        return Parser(fn, memoize=False, failure="Failed to match literal at position {pos}")
 
 
-@Parser
-def never(ctx):
-    raise reports.RecoverableError("Never")
+# Used as the default terminator everywhere; remembering that it fails would only skew the hit rate
+never = Parser(lambda ctx: FAIL, memoize=False, failure="Never")
 
 
 @Parser
 def eof(ctx):
     ctx.skip_whitespace()
     if ctx.pos < len(ctx.code):
-        raise reports.RecoverableError("Failed to match EOF")
+        return FAIL
     return ""
 
 
@@ -167,9 +249,21 @@ string_backslash = Parser.literal("\\", skip_whitespace_before=False)
 # trouble. We white-list what's reasonable.
 caret_parenthesis = Parser.regex(r"\^[$_=[\]\\{}|:/<>?]")
 
-local_symbol_literal = Parser.regex(r"\d[a-z_0-9$.]*")
-symbol_literal = Parser.regex(r"[a-z_$][a-z_0-9$.]*")
-instruction_name = Parser.regex(r"\.?[a-z_][a-z_0-9]*")
+word = Parser.token(Lexer.match_word)
+local_symbol_literal = Parser.token(Lexer.match_local_symbol)
+symbol_literal = Parser.token(Lexer.match_symbol)
+instruction_name = Parser.token(Lexer.match_instruction_name)
+
+
+caret_numbers = [
+    (prefix, adjective, Parser.literal(prefix), Parser.regex(rf"{digit_regex}+(?![$_.])\b", skip_whitespace_before=False), base)
+    for prefix, adjective, digit_regex, base in (
+        ("^X", "A hexadecimal", r"[0-9a-f]", 16),
+        ("^O", "An octal", r"[0-7]", 8),
+        ("^B", "A binary", r"[01]", 2),
+        ("^D", "A decimal", r"\d", 10)
+    )
+]
 
 
 @Parser
@@ -183,26 +277,23 @@ def number(ctx, terminator=never):
     sign_str = "-" if negative else ""
 
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
     # Macro-11-style numbers
-    for prefix, adjective, digit_regex, base in (
-        ("^X", "A hexadecimal", r"[0-9a-f]", 16),
-        ("^O", "An octal", r"[0-7]", 8),
-        ("^B", "A binary", r"[01]", 2),
-        ("^D", "A decimal", r"\d", 10)
-    ):
-        if Parser.literal(prefix)(ctx, maybe=True):
-            num = Parser.regex(rf"{digit_regex}+(?![$_.])\b", skip_whitespace_before=False)(ctx, report=(
+    for prefix, adjective, prefix_literal, digits, base in caret_numbers:
+        if prefix_literal(ctx, maybe=True):
+            num = digits(ctx, report=lambda adjective=adjective, prefix=prefix: (
                 reports.critical,
                 "invalid-number",
-                (ctx_start, ctx, f"{adjective} number was expected after '{prefix}'")
+                (ctx.at(start), ctx, f"{adjective} number was expected after '{prefix}'")
             ))
 
-            return types.Number(ctx_start, ctx, sign_str + prefix + num, int(num, base) * sign, is_valid_label=False)
+            return types.Number(ctx.at(start), ctx, sign_str + prefix + num, int(num, base) * sign, is_valid_label=False)
 
     # Every other kind of number is also a valid local symbol literal. Parse it as such first.
-    num = local_symbol_literal(ctx)
+    num = local_symbol_literal(ctx, maybe=True)
+    if num is None:
+        return FAIL
 
     # This is exactly the reason we have the colon
     if (~terminator + colon)(ctx, maybe=True):
@@ -223,7 +314,7 @@ def number(ctx, terminator=never):
     if num.isdigit():
         if has_dot:
             # Decimal
-            return types.Number(ctx_start, ctx, f"{sign_str}{num}.", int(num, 10) * sign, is_valid_label=False)
+            return types.Number(ctx.at(start), ctx, f"{sign_str}{num}.", int(num, 10) * sign, is_valid_label=False)
 
         if "8" in num or "9" in num:
             # Should be octal, but is not. This should be parsed as a local label, but it would be
@@ -237,16 +328,16 @@ def number(ctx, terminator=never):
                 char = "8" if "8" in num else "9"
                 reports.error(
                     "invalid-number",
-                    (ctx_start, ctx, f"In PDP-11 assembly, numbers are considered base-8 by default.\nThis number has digit {char}, so you probably wanted it base-10.\nAdd a dot after the number to switch to decimal: '-{num}.'\nIf you wanted to specify a local label of the same name, add a colon: '-{num}:'")
+                    (ctx.at(start), ctx, f"In PDP-11 assembly, numbers are considered base-8 by default.\nThis number has digit {char}, so you probably wanted it base-10.\nAdd a dot after the number to switch to decimal: '-{num}.'\nIf you wanted to specify a local label of the same name, add a colon: '-{num}:'")
                 )
                 # Don't set invalid_base8 because we have already reported that for better
                 # responsibility.
-                return types.Number(ctx_start, ctx, f"-{num}", int(num, 10) * sign, is_valid_label=False, invalid_base8=False)
+                return types.Number(ctx.at(start), ctx, f"-{num}", int(num, 10) * sign, is_valid_label=False, invalid_base8=False)
 
-            return types.Number(ctx_start, ctx, num, int(num, 10) * sign, is_valid_label=True, invalid_base8=True)
+            return types.Number(ctx.at(start), ctx, num, int(num, 10) * sign, is_valid_label=True, invalid_base8=True)
 
         # The easy part--an octal number
-        return types.Number(ctx_start, ctx, f"{sign_str}{num}", int(num, 8) * sign, is_valid_label=sign == 1)
+        return types.Number(ctx.at(start), ctx, f"{sign_str}{num}", int(num, 8) * sign, is_valid_label=sign == 1)
 
     # This is the hard part. How do we handle something that looks suspiciously similar to a number
     # but does not parse as such? The question is whether we parse it as a local label or abort
@@ -280,26 +371,28 @@ def number(ctx, terminator=never):
             # Must be a label then
             raise reports.RecoverableError("Local label, not a number") from None
 
-        return types.Number(ctx_start, ctx, sign_str + num, value, is_valid_label=sign == 1)
+        return types.Number(ctx.at(start), ctx, sign_str + num, value, is_valid_label=sign == 1)
 
     # A weird bundle of digits and characters that doesn't parse in any known way. The definition of
     # a local label, that is.
     raise reports.RecoverableError("Local label, not a number")
 
 
+radix50_prefix = Parser.literal("^R")
 radix50_chars = Parser.regex("[" + re.escape(radix50.TABLE.replace(" ", "")) + "]+", skip_whitespace_before=False)
 
 @Parser
 def radix50_literal(ctx):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
-    Parser.literal("^R")(ctx)
+    if radix50_prefix(ctx, maybe=True) is None:
+        return FAIL
 
-    string = radix50_chars(ctx, report=(
+    string = radix50_chars(ctx, report=lambda: (
         reports.error,
         "invalid-string",
-        (ctx_start, ctx, "Up to three radix-50 characters are expected after ^R.")
+        (ctx.at(start), ctx, "Up to three radix-50 characters are expected after ^R.")
     ))
     if string is None:
         string = ""
@@ -307,69 +400,73 @@ def radix50_literal(ctx):
     if len(string) > 3:
         reports.error(
             "invalid-string",
-            (ctx_start, ctx, f"This radix-50 literal contains more than 3 characters ({len(string)}, in particular).")
+            (ctx.at(start), ctx, f"This radix-50 literal contains more than 3 characters ({len(string)}, in particular).")
         )
         string = string[:3]
 
     string = string.upper()
 
-    return types.Number(ctx_start, ctx, f"^R{string}", radix50.pack_to_int(string), is_valid_label=False)
+    return types.Number(ctx.at(start), ctx, f"^R{string}", radix50.pack_to_int(string), is_valid_label=False)
 
 
 @Parser
 def label(ctx):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
-    name = Parser.regex(r"[a-z_0-9$.]+")(ctx)
-    colon(ctx)
+    name = word(ctx, maybe=True)
+    if name is None or colon(ctx, maybe=True) is None:
+        return FAIL
 
     is_extern = bool(Parser.literal(":", skip_whitespace_before=False)(ctx, maybe=True))
 
     if name in builtin_commands:
         reports.warning(
             "suspicious-name",
-            (ctx_start, ctx, "This symbol suspiciously resembles an instruction, but is parsed as a label definition.\nPlease consider changing the label not to look like an instruction")
+            (ctx.at(start), ctx, "This symbol suspiciously resembles an instruction, but is parsed as a label definition.\nPlease consider changing the label not to look like an instruction")
         )
-    elif name.lower() in REGISTER_NAMES:
+    elif ctx.source.lexer.folded_text(start, start + len(name)) in REGISTER_NAMES:
         reports.error(
             "reserved-name",
-            (ctx_start, ctx, "Label name clashes with a register. All accesses to this symbol would be ambiguous.")
+            (ctx.at(start), ctx, "Label name clashes with a register. All accesses to this symbol would be ambiguous.")
         )
 
     if name[0].isdigit() and is_extern:
         is_extern = False
         reports.error(
             "invalid-extern",
-            (ctx_start, ctx, "A local label cannot be external. Either give it a global name or remove double colon.")
+            (ctx.at(start), ctx, "A local label cannot be external. Either give it a global name or remove double colon.")
         )
 
-    return types.Label(ctx_start, ctx, name, is_extern=is_extern)
+    return types.Label(ctx.at(start), ctx, name, is_extern=is_extern)
 
 
 @Parser
 def assignment(ctx):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
     target = instruction_pointer(ctx, maybe=True)
     if not target:
-        symbol = symbol_literal(ctx)
-        target = types.Symbol(ctx_start, ctx, symbol)
+        symbol = symbol_literal(ctx, maybe=True)
+        if symbol is None:
+            return FAIL
+        target = types.Symbol(ctx.at(start), ctx, symbol)
 
     ctx.skip_whitespace()
 
-    ctx_equals = ctx.save()
-    equals_sign(ctx)
+    equals_pos = ctx.pos
+    if equals_sign(ctx, maybe=True) is None:
+        return FAIL
     is_extern = bool(Parser.literal("=", skip_whitespace_before=False)(ctx, maybe=True))
-    ctx_after_equals = ctx.save()
+    after_equals_pos = ctx.pos
 
     ctx.skip_whitespace()
 
-    value = expression(ctx, report=(
+    value = expression(ctx, report=lambda: (
         reports.critical,
         "invalid-assignment",
-        (ctx_equals, ctx_after_equals, "An equals sign must be followed by an expression (as in assignment)"),
+        (ctx.at(equals_pos), ctx.at(after_equals_pos), "An equals sign must be followed by an expression (as in assignment)"),
         (ctx, ctx, "...yet no expression was matched here")
     ))
 
@@ -388,49 +485,55 @@ def assignment(ctx):
     if is_extern and isinstance(target, types.InstructionPointer):
         reports.error(
             "invalid-assignment",
-            (ctx_start, ctx_after_equals, "Assignment to '.' cannot be external")
+            (ctx.at(start), ctx.at(after_equals_pos), "Assignment to '.' cannot be external")
         )
         is_extern = False
 
-    return types.Assignment(ctx_start, ctx, target, value, is_extern=is_extern)
+    return types.Assignment(ctx.at(start), ctx, target, value, is_extern=is_extern)
 
 
 @Parser
 def symbol_expression(ctx, terminator=never):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
-    symbol = symbol_literal(ctx)
+    symbol = symbol_literal(ctx, maybe=True)
+    if symbol is None:
+        return FAIL
     has_colon = bool((~terminator + colon)(ctx, maybe=True))
 
     if symbol in builtin_commands and not has_colon:
         reports.warning(
             "suspicious-name",
-            (ctx_start, ctx, "This symbol suspiciously resembles an instruction, but is parsed as an operand.\nCheck for a missing newline or an excess comma before it.")
+            (ctx.at(start), ctx, "This symbol suspiciously resembles an instruction, but is parsed as an operand.\nCheck for a missing newline or an excess comma before it.")
         )
 
-    return types.Symbol(ctx_start, ctx, symbol, is_necessarily_label=has_colon)
+    return types.Symbol(ctx.at(start), ctx, symbol, is_necessarily_label=has_colon)
 
 
 @Parser
 def local_symbol_expression(ctx, terminator=never):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
-    symbol = local_symbol_literal(ctx)
+    start = ctx.pos
+    symbol = local_symbol_literal(ctx, maybe=True)
+    if symbol is None:
+        return FAIL
     has_colon = bool((~terminator + colon)(ctx, maybe=not symbol.isdigit()))
-    return types.Symbol(ctx_start, ctx, symbol, is_necessarily_label=has_colon)
+    return types.Symbol(ctx.at(start), ctx, symbol, is_necessarily_label=has_colon)
 
 
+hex_escape_digits = Parser.regex(r"[0-9a-f]{2}")
+
 @Parser
 def string_escape(ctx):
-    ctx_start = ctx.save()
+    start = ctx.pos
 
     string_backslash(ctx)
 
-    char = character(ctx, report=(
+    char = character(ctx, report=lambda: (
         reports.error,
         "invalid-escape",
-        (ctx_start, ctx, "A letter is expected after a backslash '\\' in a string")
+        (ctx.at(start), ctx, "A letter is expected after a backslash '\\' in a string")
     )).lower()
 
     if char == "n":
@@ -444,16 +547,16 @@ def string_escape(ctx):
     elif char == "\n":
         return ""
     elif char == "x":
-        num = Parser.regex(r"[0-9a-f]{2}")(ctx, report=(
+        num = hex_escape_digits(ctx, report=lambda: (
             reports.error,
             "invalid-escape",
-            (ctx_start, ctx, "Two hexadecimal digits are expected after '\\x' in a string")
+            (ctx.at(start), ctx, "Two hexadecimal digits are expected after '\\x' in a string")
         ))
         return chr(int(num, 16))
     else:
         reports.error(
             "invalid-escape",
-            (ctx_start, ctx, f"Unknown escape '\\{char}' in a string")
+            (ctx.at(start), ctx, f"Unknown escape '\\{char}' in a string")
         )
         return ""
 
@@ -463,14 +566,15 @@ string_char = string_escape | character
 @Parser
 def single_quoted_literal(ctx):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
-    single_quote(ctx)
+    if single_quote(ctx, maybe=True) is None:
+        return FAIL
 
     if ctx.pos == len(ctx.code) or ctx.code[ctx.pos] in "\t\r\n":
         reports.critical(
             "unterminated-string",
-            (ctx_start, ctx, "Unterminated string literal. A single character is expected after '.")
+            (ctx.at(start), ctx, "Unterminated string literal. A single character is expected after '.")
         )
 
     value = ""
@@ -481,18 +585,19 @@ def single_quoted_literal(ctx):
         single_quote(ctx)
         reports.warning(
             "excess-quote",
-            (ctx_start, ctx, "Single quotation mark denotes not a string, but an ASCII value of a character.\nUnlike C, a character must not be terminated by a single quotation mark.\nFor example, 'a should be used instead of 'a'. " + ["An empty string can be safely replaced with a zero.", "Please remove the second quotation mark."][len(value)])
+            (ctx.at(start), ctx, "Single quotation mark denotes not a string, but an ASCII value of a character.\nUnlike C, a character must not be terminated by a single quotation mark.\nFor example, 'a should be used instead of 'a'. " + ["An empty string can be safely replaced with a zero.", "Please remove the second quotation mark."][len(value)])
         )
 
-    return types.CharLiteral(ctx_start, ctx, "'" + value, value)
+    return types.CharLiteral(ctx.at(start), ctx, "'" + value, value)
 
 
 @Parser
 def double_quoted_literal(ctx):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
-    double_quote(ctx)
+    if double_quote(ctx, maybe=True) is None:
+        return FAIL
 
     value = ""
 
@@ -500,7 +605,7 @@ def double_quoted_literal(ctx):
         if ctx.pos == len(ctx.code) or ctx.code[ctx.pos] in "\t\r\n":
             reports.critical(
                 "unterminated-string",
-                (ctx_start, ctx, "Unterminated string literal. Exactly two characters are expected after \".")
+                (ctx.at(start), ctx, "Unterminated string literal. Exactly two characters are expected after \".")
             )
         if ctx.code[ctx.pos] != "\"":
             value += string_char(ctx)
@@ -509,16 +614,16 @@ def double_quoted_literal(ctx):
         double_quote(ctx)
         reports.warning(
             "excess-quote",
-            (ctx_start, ctx, "Double quotation mark does not denote a string. It denotes an ASCII conversion operator,\nwhich means that the two characters after \" are converted to a 16-bit word.\nFor example, \"AB is the same as 0x4142 (or ^H4142).\n" + ["An empty string, as here, can be safely replaced with a zero.", f"Exactly two characters are expected after the quotation mark, and the closing mark is unnecessary.\nPlease use '{value} instead.", f"Unlike C, this literal must not be terminated by a quotation mark -- please remove it: \"{value}"][len(value)])
+            (ctx.at(start), ctx, "Double quotation mark does not denote a string. It denotes an ASCII conversion operator,\nwhich means that the two characters after \" are converted to a 16-bit word.\nFor example, \"AB is the same as 0x4142 (or ^H4142).\n" + ["An empty string, as here, can be safely replaced with a zero.", f"Exactly two characters are expected after the quotation mark, and the closing mark is unnecessary.\nPlease use '{value} instead.", f"Unlike C, this literal must not be terminated by a quotation mark -- please remove it: \"{value}"][len(value)])
         )
 
-    return types.CharLiteral(ctx_start, ctx, "\"" + value, value)
+    return types.CharLiteral(ctx.at(start), ctx, "\"" + value, value)
 
 
 @Parser
 def quoted_string(ctx):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
     quote = string_quote(ctx)
     value = ""
@@ -528,31 +633,34 @@ def quoted_string(ctx):
     if ctx.pos == len(ctx.code):
         reports.critical(
             "unterminated-string",
-            (ctx_start, ctx, "Unterminated string literal")
+            (ctx.at(start), ctx, "Unterminated string literal")
         )
 
     ctx.pos += 1
-    return types.QuotedString(ctx_start, ctx, quote, value)
+    return types.QuotedString(ctx.at(start), ctx, quote, value)
 
 
 @Parser
 def angle_bracketed_char(ctx):
-    ctx_start = ctx.save()
+    start = ctx.pos
     opening_angle_bracket(ctx)
     expr = expression(ctx)
     closing_angle_bracket(ctx)
-    return types.AngleBracketedChar(ctx_start, ctx, expr)
+    return types.AngleBracketedChar(ctx.at(start), ctx, expr)
+
+
+string_chunk = quoted_string | angle_bracketed_char
 
 
 @Parser
 def long_string(ctx):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
-    chunks = [(quoted_string | angle_bracketed_char)(ctx)]
+    chunks = [string_chunk(ctx)]
 
     while True:
-        chunk = (quoted_string | angle_bracketed_char)(ctx, maybe=True)
+        chunk = string_chunk(ctx, maybe=True)
         if chunk is None:
             break
         chunks.append(chunk)
@@ -561,7 +669,7 @@ def long_string(ctx):
         # For performance. Maybe.
         return chunks[0]
     else:
-        return types.StringConcatenation(ctx_start, ctx, chunks)
+        return types.StringConcatenation(ctx.at(start), ctx, chunks)
 
 
 # TODO: Terrible. Macro-11 supports 'x for single-character constants and
@@ -626,12 +734,19 @@ def long_string(ctx):
 
 
 
+instruction_pointer_dot = Parser.regex(r"\.(?![a-z_0-9])")
+
 @Parser
 def instruction_pointer(ctx):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
-    Parser.regex(r"\.(?![a-z_0-9])")(ctx)
-    return types.InstructionPointer(ctx_start, ctx)
+    start = ctx.pos
+    if instruction_pointer_dot(ctx, maybe=True) is None:
+        return FAIL
+    return types.InstructionPointer(ctx.at(start), ctx)
+
+
+number_or_local_symbol = number | local_symbol_expression
+quoted_literal_or_instruction_pointer = single_quoted_literal | double_quoted_literal | instruction_pointer
 
 
 @Parser
@@ -644,27 +759,75 @@ def expression_literal(ctx, terminator=never):
     if expr is not None:
         return expr
 
-    expr = (number | local_symbol_expression)(ctx, terminator=terminator, maybe=True)
+    expr = number_or_local_symbol(ctx, terminator=terminator, maybe=True)
     if expr is not None:
         return expr
 
-    return (single_quoted_literal | double_quoted_literal | instruction_pointer)(ctx)
+    expr = quoted_literal_or_instruction_pointer(ctx, maybe=True)
+    return FAIL if expr is None else expr
+
+
+def build_operator_trie(table):
+    # Nested dicts keyed by lowercase characters; None marks the end of an operator
+    trie = {}
+    for char, operator in table.items():
+        node = trie
+        for trie_char in char.lower():
+            node = node.setdefault(trie_char, {})
+        node[None] = operator
+    return trie
+
+
+def match_operator(ctx, trie):
+    # Finds the longest operator at the current position and moves past it. Returns the operator
+    # class, or None without moving.
+    folded = ctx.source.folded_code
+    node = trie
+    pos = ctx.pos
+    operator = None
+    while pos < len(folded):
+        node = node.get(folded[pos])
+        if node is None:
+            break
+        pos += 1
+        if None in node:
+            operator = node[None]
+            ctx.pos = pos
+    return operator
+
+
+def operator_parser(trie):
+    def fn(ctx):
+        ctx.skip_whitespace()
+        operator = match_operator(ctx, trie)
+        return FAIL if operator is None else operator.char
+    return Parser(fn, memoize=False, failure="Failed to match an operator at position {pos}")
+
+
+infix_operators = build_operator_trie(operators.operators[operators.InfixOperator])
+prefix_operators = build_operator_trie(operators.operators[operators.PrefixOperator])
+postfix_operators = build_operator_trie(operators.operators[operators.PostfixOperator])
 
+infix_operator = operator_parser(infix_operators)
+prefix_operator = operator_parser(prefix_operators)
+postfix_operator = operator_parser(postfix_operators)
 
-infix_operator = Parser.either([Parser.literal(op) for op in operators.operators[operators.InfixOperator]])
-prefix_operator = Parser.either([Parser.literal(op) for op in operators.operators[operators.PrefixOperator]])
-postfix_operator = Parser.either([Parser.literal(op) for op in operators.operators[operators.PostfixOperator]])
+caret_prefix_operator = Parser.regex(r"\^\S")
+postfix_operator_follower = newline | comma | closing_parenthesis | closing_bracket | eof
+any_opening_parenthesis = opening_parenthesis | opening_angle_bracket | caret_parenthesis
 
 
 @Parser
 def expression_literal_rec(ctx, terminator):
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
+    start = ctx.pos
 
-    if (opening_parenthesis | opening_angle_bracket | caret_parenthesis)(ctx, maybe=True, lookahead=True):
+    if any_opening_parenthesis(ctx, maybe=True, lookahead=True):
         value = None
     else:
-        value = expression_literal(ctx, terminator=terminator)
+        value = expression_literal(ctx, terminator=terminator, maybe=True)
+        if value is None:
+            return FAIL
 
     while True:
         # <x> is allowed and means the same as (x)
@@ -673,7 +836,7 @@ def expression_literal_rec(ctx, terminator):
         # (a)<b> is a syntax error
         # <a><b> is a syntax error too
         if value is None:
-            opening = (opening_parenthesis | opening_angle_bracket | caret_parenthesis)(ctx, maybe=True)
+            opening = any_opening_parenthesis(ctx, maybe=True)
         else:
             opening = opening_parenthesis(ctx, maybe=True)
         if opening is None:
@@ -690,40 +853,120 @@ def expression_literal_rec(ctx, terminator):
         else:
             assert False  # pragma: no cover
 
-        ctx_after_paren = ctx.save()
+        after_paren_pos = ctx.pos
         ctx.skip_whitespace()
 
-        expr = expression(ctx, terminator=new_terminator, report=(
+        expr = expression(ctx, terminator=new_terminator, report=lambda: (
             reports.critical,
             "invalid-expression",
             (ctx, ctx, "Could not parse an expression here"),
-            (ctx_start, ctx_after_paren, "...as expected after an opening parenthesis here")
+            (ctx.at(start), ctx.at(after_paren_pos), "...as expected after an opening parenthesis here")
         ))
 
         ctx.skip_whitespace()
 
-        Parser.literal(closing)(ctx, report=(
+        Parser.literal(closing)(ctx, report=lambda: (
             reports.critical,
             "invalid-expression",
             (ctx, ctx, "This is not a operator, so a closing parenthesis is expected here"),
-            (ctx_start, ctx_after_paren, "...to match an opening parenthesis here")
+            (ctx.at(start), ctx.at(after_paren_pos), "...to match an opening parenthesis here")
         ))
 
         if value is None:
-            value = types.ParenthesizedExpression(ctx_start, ctx, expr, opening_parenthesis=opening, closing_parenthesis=closing)
+            value = types.ParenthesizedExpression(ctx.at(start), ctx, expr, opening_parenthesis=opening, closing_parenthesis=closing)
         else:
-            value = operators.call(ctx_start, ctx, value, expr)
+            value = operators.call(ctx.at(start), ctx, value, expr)
 
     return value
 
 
+class PrecedenceClimber:
+    # Builds the operator tree to the right of an operand: each climb() call takes the operators
+    # that bind tighter than the one it was started for and leaves the rest to its callers. The
+    # operator after an operand is looked up once and shared by all the levels it is passed through.
+
+    def __init__(self, ctx, terminator):
+        self.ctx = ctx
+        self.terminator = terminator
+        self.peeked_pos = -1
+        self.peeked = None
+        self.finished = False
+
+
+    def peek(self):
+        ctx = self.ctx
+        if self.peeked_pos != ctx.pos:
+            self.peeked_pos = ctx.pos
+            self.peeked = self.find_operator()
+            ctx.pos = self.peeked_pos
+        return self.peeked
+
+
+    def find_operator(self):
+        ctx = self.ctx
+        ctx.skip_whitespace()
+        op_pos = ctx.pos
+
+        if self.terminator(ctx, maybe=True, lookahead=True):
+            return None
+
+        # A plus or a minus is a postfix operator only if nothing but a comma, a closing bracket or
+        # a newline follows
+        operator = match_operator(ctx, postfix_operators)
+        if operator is not None and postfix_operator_follower(ctx, maybe=True, lookahead=True) is not None:
+            return operator, op_pos, ctx.pos
+
+        ctx.pos = op_pos
+        operator = match_operator(ctx, infix_operators)
+        if operator is None:
+            return None
+        return operator, op_pos, ctx.pos
+
+
+    def climb(self, lhs, max_precedence):
+        ctx = self.ctx
+
+        # TODO: Macro-11 doesn't support operator precedence, it evaluates infix
+        # operators left to right. This may cause problems in code such as
+        # '1 + 2 * 3' which Macro-11 evaluates to 9 and PDPy11 evaluates to
+        # 7. We should emit a warning or handle this differently in Macro-11 and
+        # pdp11asm compatibility modes.
+        while not self.finished:
+            peeked = self.peek()
+            if peeked is None:
+                break
+            operator, op_pos, op_end_pos = peeked
+
+            precedence = operator.precedence
+            if precedence > max_precedence or (precedence == max_precedence and operator.associativity == "left"):
+                break
+
+            ctx.pos = op_end_pos
+
+            if issubclass(operator, operators.PostfixOperator):
+                # Nothing can follow a postfix operator, so the expression ends here
+                self.finished = True
+                return operator(ctx.at(op_pos), ctx, lhs)
+
+            rhs = expression_literal_rec(ctx, terminator=self.terminator, report=lambda: (  # pylint: disable=cell-var-from-loop
+                reports.critical,
+                "invalid-expression",
+                (ctx, ctx, "Could not parse an expression here"),
+                (ctx.at(op_pos), ctx.at(op_end_pos), f"...as expected after operator '{operator.char}'." + (" If this was intended as two closing parentheses rather than right shift, please add spaces: '> >'." if operator.char == ">>" else ""))
+            ))
+            rhs = self.climb(rhs, precedence)
+            lhs = operator(lhs.ctx_start, ctx, lhs, rhs)
+
+        return lhs
+
+
 @Parser
 def expression(ctx, terminator=never):
-    op_stack = []
+    prefix_stack = []
 
     ctx.skip_whitespace()
-    ctx_start = ctx.save()
-    ctx_op = ctx.save()
+    start = ctx.pos
+    op_pos = ctx.pos
 
     # Try to match a full expression before matching a prefix operator, so that
     # -1 is parsed as -1, not -(1)
@@ -732,120 +975,44 @@ def expression(ctx, terminator=never):
         if expr is not None:
             break
 
-        report = (
+        report = (lambda: (
             reports.critical,
             "invalid-expression",
             (ctx, ctx, "Expected an expression or an operator here"),
-            (ctx_start, ctx, "...after a prefix here")
-        ) if op_stack else None
+            (ctx.at(start), ctx, "...after a prefix here")
+        )) if prefix_stack else None
 
         (~terminator)(ctx, report=report)
 
-        char = prefix_operator(ctx, maybe=True)
-        if char is None:
+        ctx.skip_whitespace()
+        operator = match_operator(ctx, prefix_operators)
+        if operator is None:
             # This is an error either way, but this lets us report typos in caret-style prefix
             # operators
-            ctx.skip_whitespace()
-            ctx_before_op = ctx.save()
-            prefix_op = Parser.regex(r"\^\S")(ctx, report=report)
+            before_op_pos = ctx.pos
+            prefix_op = caret_prefix_operator(ctx, report=report)
             reports.critical(
                 "invalid-expression",
-                (ctx_before_op, ctx, f"'{prefix_op}' is an invalid prefix operator")
+                (ctx.at(before_op_pos), ctx, f"'{prefix_op}' is an invalid prefix operator")
             )
 
-        op_stack.append({
-            "ctx_start": ctx_op,
-            "operator": operators.operators[operators.PrefixOperator][char]
-        })
+        prefix_stack.append((op_pos, operator))
 
         ctx.skip_whitespace()
-        ctx_op = ctx.save()
-
-    stack = [expr]
-
-    def pop_op_stack(ctx_end):
-        info = op_stack.pop()
-        operator = info["operator"]
-        if issubclass(operator, operators.InfixOperator):
-            rhs = stack.pop()
-            lhs = stack.pop()
-            stack.append(operator(lhs.ctx_start, ctx_end, lhs, rhs))
-        else:
-            op_operand = stack.pop()
-            stack.append(operator(info["ctx_start"], ctx_end, op_operand))
-
-
-    # TODO: Macro-11 doesn't support operator precedence, it evaluates infix
-    # operators left to right. This may cause problems in code such as
-    # '1 + 2 * 3' which Macro-11 evaluates to 9 and PDPy11 evaluates to
-    # 7. We should emit a warning or handle this differently in Macro-11 and
-    # pdp11asm compatibility modes.
-    while True:
-        ctx_prev = ctx.save()
-
-        ctx.skip_whitespace()
-        ctx_op = ctx.save()
-
-        if (~terminator + postfix_operator + (newline | comma | closing_parenthesis | closing_bracket | eof))(ctx, maybe=True, lookahead=True):
-            # Postfix operator
-            char = postfix_operator(ctx)
-            ctx_op_end = ctx.save()
-
-            operator = operators.operators[operators.PostfixOperator][char]
+        op_pos = ctx.pos
 
-            self_precedence = operator.precedence
-            is_left_associative = operator.associativity == "left"
+    climber = PrecedenceClimber(ctx, terminator)
 
-            while op_stack and (self_precedence, is_left_associative) > (op_stack[-1]["operator"].precedence, False):
-                pop_op_stack(ctx_prev)
+    # A prefix operator takes as its operand everything that binds tighter than itself
+    while prefix_stack:
+        op_pos, operator = prefix_stack.pop()
+        expr = climber.climb(expr, operator.precedence)
+        expr = operator(ctx.at(op_pos), ctx, expr)
 
-            stack[-1] = operator(ctx_op, ctx_op_end, stack[-1])
-            break
-        else:
-            # Must be an infix operator
-            char = (~terminator + infix_operator)(ctx, maybe=True)
-            if not char:
-                ctx.restore(ctx_prev)
-                break
-
-            ctx_op_end = ctx.save()
-
-            operator = operators.operators[operators.InfixOperator][char]
+    return climber.climb(expr, float("inf"))
 
-            expr = expression_literal_rec(ctx, terminator=terminator, report=(
-                reports.critical,
-                "invalid-expression",
-                (ctx, ctx, "Could not parse an expression here"),
-                (ctx_op, ctx_op_end, f"...as expected after operator '{char}'." + (" If this was intended as two closing parentheses rather than right shift, please add spaces: '> >'." if char == ">>" else ""))
-            ))
-
-            self_precedence = operator.precedence
-            is_left_associative = operator.associativity == "left"
-
-            while op_stack and (self_precedence, is_left_associative) > (op_stack[-1]["operator"].precedence, False):
-                pop_op_stack(ctx_prev)
-
-            stack.append(expr)
-            op_stack.append({
-                "operator": operator
-            })
-
-    while op_stack:
-        pop_op_stack(ctx)
-
-    return stack[-1]
-
-
-def parse_insn_operand(ctx, insn_name, operand_idx, **kwargs):
-    if insn_name in builtin_commands:
-        insn = builtin_commands[insn_name]
-    elif "." + insn_name in builtin_commands:
-        # A warning will be emitted later by the compiler, no need to emit it
-        # now
-        insn = builtin_commands["." + insn_name]
-    else:
-        insn = None
 
+def parse_insn_operand(ctx, insn_name, insn, operand_idx, **kwargs):
     is_metacommand = insn_name.startswith(".") or isinstance(insn, Metacommand)
     if is_metacommand:
         if insn is not None and insn.operand_info:
@@ -874,6 +1041,12 @@ def parse_insn_operand(ctx, insn_name, operand_idx, **kwargs):
         return expression(ctx, **kwargs)
 
 
+# Hoisted so that they are not rebuilt for every instruction
+implicit_word_follower = comma | (~prefix_operator + ~caret_parenthesis + infix_operator)
+next_instruction_name = instruction_name + ~colon
+operand_continuation = comma | infix_operator | postfix_operator
+
+
 @Parser
 def instruction(ctx):
     # TODO: Macro-11 supports .rem metacommand for comments, like this:
@@ -882,26 +1055,36 @@ def instruction(ctx):
     #   comment closes here /
     # (the first character after '.rem' is a 'quotation' sign)
 
-    ctx_start = ctx.save()
-    insn_name = instruction_name(ctx)
-    if insn_name.lower() in REGISTER_NAMES:
+    start = ctx.pos
+    insn_name = instruction_name(ctx, maybe=True)
+    if insn_name is None:
+        return FAIL
+    if ctx.source.lexer.folded_text(ctx.pos - len(insn_name), ctx.pos) in REGISTER_NAMES:
         reports.warning(
             "suspicious-name",
-            (ctx_start, ctx, "Instruction name suspiciously resembles a register.\nCheck for an excess newline or a missing comma before the register name")
+            (ctx.at(start), ctx, "Instruction name suspiciously resembles a register.\nCheck for an excess newline or a missing comma before the register name")
         )
-    ctx_state_after_name = ctx.save()
-    insn_name_symbol = types.Symbol(ctx_start, ctx_state_after_name, insn_name)
+    after_name_pos = ctx.pos
+    insn_name_symbol = types.Symbol(ctx.at(start), ctx, insn_name)
 
+    command = builtin_commands.get(insn_name)
+    if command is not None:
+        operand_command = command
+    else:
+        # A warning will be emitted later by the compiler, no need to emit it
+        # now
+        operand_command = builtin_commands.get("." + insn_name)
 
-    if insn_name in builtin_commands:
+
+    if command is not None:
         if comma(ctx, maybe=True, lookahead=True):
             ctx.skip_whitespace()
-            ctx_before_comma = ctx.save()
+            before_comma_pos = ctx.pos
             comma(ctx)
             reports.critical(
                 "invalid-insn",
-                (ctx_before_comma, ctx, f"Unexpected comma right after instruction name; expected an operand. This is not\nparsed as implicit '.word' because '{insn_name}' is a real instruction."),
-                (ctx_start, ctx_state_after_name, "Instruction started here")
+                (ctx.at(before_comma_pos), ctx, f"Unexpected comma right after instruction name; expected an operand. This is not\nparsed as implicit '.word' because '{insn_name}' is a real instruction."),
+                (ctx.at(start), ctx.at(after_name_pos), "Instruction started here")
             )
     elif not insn_name.startswith("."):
         # Potentially implicit '.word'. If this is followed by a comma, this is certainly a word
@@ -913,12 +1096,11 @@ def instruction(ctx):
         # Both cases are valid, but assuming the latter might cause unclear diagnostics, so we parse
         # it as the former. People can always switch to the former by using explicit .word or
         # parentheses.
-        pattern = comma | (~prefix_operator + ~caret_parenthesis + infix_operator)
-        if pattern(ctx, maybe=True):
+        if implicit_word_follower(ctx, maybe=True):
             raise reports.RecoverableError("Implicit word, not an instruction")
 
 
-    if insn_name in builtin_commands and isinstance(builtin_commands[insn_name], Metacommand) and builtin_commands[insn_name].literal_string_operand:
+    if isinstance(command, Metacommand) and command.literal_string_operand:
         idx = ctx.code.find("\n", ctx.pos)
         if idx == -1:
             idx = len(ctx.code)
@@ -926,21 +1108,21 @@ def instruction(ctx):
         text = ctx.code[ctx.pos:idx].strip()
         if text:
             ctx.skip_whitespace()
-            ctx_before_message = ctx.save()
+            before_message_pos = ctx.pos
             ctx.pos += len(text)
-            operands = [types.QuotedString(ctx_before_message, ctx, "", text)]
+            operands = [types.QuotedString(ctx.at(before_message_pos), ctx, "", text)]
         else:
             operands = []
 
-        return types.Instruction(ctx_start, ctx, insn_name_symbol, operands)
+        return types.Instruction(ctx.at(start), ctx, insn_name_symbol, operands)
 
 
     if closing_bracket(ctx, maybe=True, lookahead=True):
-        return types.Instruction(ctx_start, ctx, insn_name_symbol, [])
+        return types.Instruction(ctx.at(start), ctx, insn_name_symbol, [])
 
 
     if newline(ctx, maybe=True, lookahead=True):
-        if insn_name in builtin_commands and builtin_commands[insn_name].min_operands > 0:
+        if command is not None and command.min_operands > 0:
             # If the command always takes an argument, there's no choice but to parse it starting
             # from the next line. This is still a bad thing to do: Macro-11 does not allow this, and
             # for a good reason:
@@ -953,13 +1135,13 @@ def instruction(ctx):
             #     .word x, y, z  # implicit .word
             reports.warning(
                 "unexpected-newline",
-                (ctx_start, ctx_state_after_name, "This instruction always takes at least one argument, but there is a newline right after its name.\nPDPy11 will attempt to parse the next line as an operand, but many other compilers (including Macro-11) wouldn't, and this can potentially even cause miscompilations.\nPlease put the operand to the same line."),
+                (ctx.at(start), ctx.at(after_name_pos), "This instruction always takes at least one argument, but there is a newline right after its name.\nPDPy11 will attempt to parse the next line as an operand, but many other compilers (including Macro-11) wouldn't, and this can potentially even cause miscompilations.\nPlease put the operand to the same line."),
             )
         else:
             # Otherwise, it's reasonable to assume no arguments, because
             # - there would be no way to specify no arguments otherwise, and
             # - Macro-11 parses this as such.
-            return types.Instruction(ctx_start, ctx, insn_name_symbol, [])
+            return types.Instruction(ctx.at(start), ctx, insn_name_symbol, [])
 
 
     # The recommended way to separate instructions is by newlines, e.g.
@@ -976,50 +1158,53 @@ def instruction(ctx):
     # the next word parses as a known instruction name, then it's two instructions. Theoretically
     # speaking, the former is condition enough, but we'd prefer 'nop @#1' to say 'nop takes no
     # arguments' rather than '@#1 is not an instruction', right?
-    next_insn_name = (instruction_name + ~colon)(ctx, maybe=True, lookahead=True)
-    if insn_name in builtin_commands and next_insn_name and builtin_commands[insn_name].max_operands == 0 and next_insn_name in builtin_commands:
+    if command is not None and command.max_operands == 0:
+        next_insn_name = next_instruction_name(ctx, maybe=True, lookahead=True)
+    else:
+        next_insn_name = None
+    if next_insn_name and next_insn_name in builtin_commands:
         ctx_before_insn = ctx.save()
         ctx_before_insn.skip_whitespace()
         next_insn_name = instruction_name(ctx_before_insn)
-        if not (comma | infix_operator | postfix_operator)(ctx_before_insn, maybe=True, lookahead=True):
+        if not operand_continuation(ctx_before_insn, maybe=True, lookahead=True):
             reports.warning(
                 "missing-newline",
-                (ctx_start, ctx_state_after_name, "There is no newline after the name of this instruction, hence an operand is naturally expected to follow,"),
+                (ctx.at(start), ctx.at(after_name_pos), "There is no newline after the name of this instruction, hence an operand is naturally expected to follow,"),
                 (ctx_before_insn, ctx_before_insn, f"but it suspiciously resembles another instruction.\nYou probably \x1b[3mmeant\x1b[23m an instruction '{insn_name}' without operands followed by a '{next_insn_name}' instruction,\nand pdpy will compile this code as such, but this is against standards; please add a newline between instructions.")
             )
-            return types.Instruction(ctx_start, ctx, insn_name_symbol, [])
+            return types.Instruction(ctx.at(start), ctx, insn_name_symbol, [])
 
 
     operands = []
 
-    first_operand = parse_insn_operand(ctx, insn_name, 0, maybe=True)
+    first_operand = parse_insn_operand(ctx, insn_name, operand_command, 0, maybe=True)
     if first_operand:
-        if ctx_state_after_name.pos < len(ctx.code) and ctx.code[ctx_state_after_name.pos].strip() != "":
+        if after_name_pos < len(ctx.code) and ctx.code[after_name_pos].strip() != "":
             reports.error(
                 "missing-whitespace",
-                (ctx_state_after_name, ctx, "Expected whitespace after instruction name. This is ambiguous: Macro-11 would\ntreat this character as a separator and ignore it, while a sane assembler would\nassume it is part of the first operand. Proceeding under the latter assumption.")
+                (ctx.at(after_name_pos), ctx, "Expected whitespace after instruction name. This is ambiguous: Macro-11 would\ntreat this character as a separator and ignore it, while a sane assembler would\nassume it is part of the first operand. Proceeding under the latter assumption.")
             )
 
         operands.append(first_operand)
 
-        ctx_before_comma = ctx.save()
+        before_comma_pos = ctx.pos
         while comma(ctx, maybe=True):
-            ctx_after_comma = ctx.save()
+            after_comma_pos = ctx.pos
             ctx.skip_whitespace()
-            oper = parse_insn_operand(ctx, insn_name, len(operands), report=(
+            oper = parse_insn_operand(ctx, insn_name, operand_command, len(operands), report=lambda: (  # pylint: disable=cell-var-from-loop
                 reports.critical,
                 "invalid-operand",
-                (ctx_before_comma, ctx_after_comma, "Expected operand after comma in an instruction"),
-                (ctx_start, ctx_state_after_name, "(instruction started here)"),
+                (ctx.at(before_comma_pos), ctx.at(after_comma_pos), "Expected operand after comma in an instruction"),
+                (ctx.at(start), ctx.at(after_name_pos), "(instruction started here)"),
                 (ctx, ctx, "This definitely does not look like an operand")
             ))
             operands.append(oper)
-            ctx_before_comma = ctx.save()
+            before_comma_pos = ctx.pos
 
-        ctx_opening_bracket = ctx.save()
+        opening_bracket_pos = ctx.pos
         if opening_bracket(ctx, maybe=True):
             oper = code(ctx, break_on_closing_bracket=True)
-            oper.ctx = ctx_opening_bracket
+            oper.ctx = ctx.at(opening_bracket_pos)
             operands.append(oper)
 
         if ctx.pos < len(ctx.code) and ctx.code[ctx.pos].strip() not in ("", ";"):
@@ -1028,82 +1213,153 @@ def instruction(ctx):
                 (ctx, ctx, "Expected whitespace after instruction. Proceeding as if a new instruction is starting")
             )
     else:
-        if ctx_state_after_name.pos < len(ctx.code):
+        if after_name_pos < len(ctx.code):
             ctx.skip_whitespace()
             reports.warning(
                 "missing-newline",
                 (ctx, ctx, "Could not parse an operand starting from here; assuming a new instruction.\nPlease add a newline here if an instruction was implied."),
-                (ctx_start, ctx_state_after_name, "The previous instruction started here")
+                (ctx.at(start), ctx.at(after_name_pos), "The previous instruction started here")
             )
 
-    return types.Instruction(ctx_start, ctx, insn_name_symbol, operands)
+    return types.Instruction(ctx.at(start), ctx, insn_name_symbol, operands)
+
+
+newline_or_eof = newline | eof
 
 
 @Parser
 def word_list(ctx):
     ctx.skip_whitespace()
 
-    ctx_start = ctx.save()
+    start = ctx.pos
     words = [expression(ctx)]
-    ctx_after_first_operand = ctx.save()
+    after_first_operand_pos = ctx.pos
 
     while True:
-        ctx_before_comma = ctx.save()
-        ctx_before_comma.skip_whitespace()
         if not comma(ctx, maybe=True):
             break
-        ctx_after_comma = ctx.save()
+        after_comma_pos = ctx.pos
         ctx.skip_whitespace()
 
-        word = expression(ctx, report=(
+        # The comma is a single character, so it starts right before after_comma_pos
+        words.append(expression(ctx, report=lambda: (  # pylint: disable=cell-var-from-loop
             reports.critical,
             "invalid-operand",
-            (ctx_before_comma, ctx_after_comma, "Expected word after comma in a word list"),
-            (ctx_start, ctx_after_first_operand, "(list started here)"),
+            (ctx.at(after_comma_pos - 1), ctx.at(after_comma_pos), "Expected word after comma in a word list"),
+            (ctx.at(start), ctx.at(after_first_operand_pos), "(list started here)"),
             (ctx, ctx, "This does not look like a word")
-        ))
-        words.append(word)
+        )))
 
     if ctx.pos < len(ctx.code) and ctx.code[ctx.pos].strip() not in ("", ";"):
         reports.error(
             "missing-whitespace",
             (ctx, ctx, "Expected whitespace after word list. Proceeding as if a new instruction is starting")
         )
-    elif (newline | eof)(ctx, maybe=True, lookahead=True) is None:
+    elif newline_or_eof(ctx, maybe=True, lookahead=True) is None:
         reports.warning(
             "missing-newline",
             (ctx, ctx, "Expected newline after a word list; assuming a new instruction. Please add a\nnewline here if an instruction was implied, and a comma if it's the continuation\nof a word list."),
-            (ctx_start, ctx, "The word list started here")
+            (ctx.at(start), ctx, "The word list started here")
         )
 
-    return types.WordList(ctx_start, ctx, words)
+    return types.WordList(ctx.at(start), ctx, words)
+
+
+statement_after_equals_sign = assignment | instruction | word_list
+statement_after_word = instruction | word_list
+
+
+def select_statement(ctx):
+    # Labels, assignments and instructions all start with a word, and the first significant
+    # character after it tells a label and an assignment apart from the rest. This saves trying
+    # every production in turn.
+    end = ctx.source.lexer.match_word(ctx.pos)
+    if end == -1:
+        return word_list
+
+    pos = ctx.pos
+    ctx.pos = end
+    ctx.skip_whitespace()
+    char = ctx.code[ctx.pos:ctx.pos + 1]
+    ctx.pos = pos
+
+    if char == ":":
+        return label
+    elif char == "=":
+        # Not necessarily an assignment, e.g. '1 = 2'
+        return statement_after_equals_sign
+    else:
+        return statement_after_word
+
+
+def statement(ctx, start):
+    return select_statement(ctx)(ctx, report=lambda: (
+        reports.critical,
+        "invalid-insn",
+        (ctx.at(start), ctx.at(start), "Could not parse instruction starting from here")
+    ))
+
+
+def is_end_of_code(insn):
+    # Because some people add junk after .end
+    return isinstance(insn, types.Instruction) and insn.name.name.lower() in ("end", ".end")
 
 
 @Parser
 def code(ctx, break_on_closing_bracket=False):
-    ctx_start = ctx.save()
+    start = ctx.pos
 
     insns = []
 
     while not ctx.eof():
         ctx.skip_whitespace()
-        ctx_start = ctx.save()
+        start = ctx.pos
         if break_on_closing_bracket and closing_bracket(ctx, maybe=True):
             break
 
-        insn = (label | assignment | instruction | word_list)(ctx, report=(
-            reports.critical,
-            "invalid-insn",
-            (ctx_start, ctx_start, "Could not parse instruction starting from here")
-        ))
+        insn = statement(ctx, start)
         insns.append(insn)
 
-        if not break_on_closing_bracket and isinstance(insn, types.Instruction) and insn.name.name.lower() in ("end", ".end"):
-            # Because some people add junk after .end
+        if not break_on_closing_bracket and is_end_of_code(insn):
             break
 
-    return types.CodeBlock(ctx_start, ctx, insns)
+    return types.CodeBlock(ctx.at(start), ctx, insns)
+
+
+def parse(filename, text, memo=None):
+    source = Source(filename, text, memo)
+    try:
+        return types.File(filename, code(Context(source)))
+    finally:
+        # The AST keeps the source alive, but the token table and the folded copy are only needed
+        # while parsing
+        source.lexer = None
+        source.folded_code = None
+        source.memo = None
+        if memo is not None:
+            memo.table.clear()
+
 
+STREAM_LEXER_WINDOW = 65536
 
-def parse(filename, text):
-    return types.File(filename, code(Context(filename, text)))
+
+def iter_statements(filename, text):
+    # Yields the top-level statements of a file one by one as they are parsed, so that the caller
+    # can compile each of them and let it go instead of keeping the whole AST around. For the same
+    # reason, only a window of the file around the current statement is tokenized at a time.
+    source = Source(filename, text, lexer=Lexer(text, 0, STREAM_LEXER_WINDOW))
+    ctx = Context(source)
+    try:
+        while not ctx.eof():
+            ctx.skip_whitespace()
+            if ctx.eof():
+                break
+            if ctx.pos >= source.lexer.end - STREAM_LEXER_WINDOW // 2:
+                source.lexer = Lexer(text, ctx.pos, ctx.pos + STREAM_LEXER_WINDOW)
+            insn = statement(ctx, ctx.pos)
+            yield insn
+            if is_end_of_code(insn):
+                break
+    finally:
+        source.lexer = None
+        source.folded_code = None
@@ -17,6 +17,11 @@ class Report:
     def __call__(self, *args, **kwargs):
         emit_report(self, *args, **kwargs)
 
+    def __reduce__(self):
+        # Handlers compare priorities by identity, so unpickle to the same module-level instance.
+        # Returning a string makes pickle store a reference to the global with that name.
+        return next(name for name, value in globals().items() if value is self)
+
 error = Report("\x1b[91mError\x1b[0m", "Error")
 critical = Report("\x1b[91mError\x1b[0m", "Error")
 warning = Report("\x1b[33mWarning\x1b[0m", "Warning")
@@ -126,7 +131,8 @@ class GraphicalHandler:
         for file_i, (filename, file_reports) in enumerate(itertools.groupby(reports, key=lambda report: report[0].filename)):
             file_reports = list(file_reports)
             ctx = file_reports[0][0]
-            lines = ctx.code.split("\n")
+            source = ctx.source
+            lines = source.lines
 
             if file_i == 0:
                 print(f"{priority.text} in \x1b[96m{filename}\x1b[0m: \x1b[38;5;208m[-W{identifier}]\x1b[0m", file=sys.stderr)
@@ -136,11 +142,9 @@ class GraphicalHandler:
             reports_lst = []
             for ctx_start, ctx_end, text in file_reports:
                 assert ctx_start.filename == ctx_end.filename
-                idx_line_start = ctx_start.code.rfind("\n", 0, ctx_start.pos) + 1
-                line_no = ctx_start.code[:idx_line_start].count("\n")
-                start_col_no = (ctx_start.pos - idx_line_start) + ctx_start.code[idx_line_start:ctx_start.pos].count("\t") * 3
+                line_no, start_col_no = source.line_and_column(ctx_start.pos)
 
-                if "\n" in ctx.code[ctx_start.pos:ctx_end.pos]:
+                if source.line_of(ctx_end.pos) != line_no:
                     # Hotfix: terminate at EOL. TODO: allow multiline reports
                     end_col_no = len(lines[line_no])
                 else:
@@ -236,11 +240,19 @@ class GraphicalHandler:
         print(file=sys.stderr)
 
 
+# Incremented on every report. The parser uses this to find out whether a sub-parse had side effects
+emitted_count = 0
+
+
 def emit_report(priority, identifier, *reports):
+    global emitted_count  # pylint: disable=global-statement
+
     if not handle_reports.handlers_stack:
         # Shouldn't happen in normal operation mode, but may be used in tests
         raise Exception(f"Unhandled report: {identifier}")  # pragma: no cover
 
+    emitted_count += 1
+
     handler = handle_reports.handlers_stack[-1]
     handler(priority, identifier, *reports)
 
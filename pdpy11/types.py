@@ -1,30 +1,58 @@
 import struct
 
 from .context import Context
-from .deferred import not_ready, Awaiting, wait
+from .deferred import not_ready, wait
 from . import reports
 
 
 class Token:
+    # A token only stores the source it was parsed from and two offsets into it. Contexts, and
+    # hence line and column numbers, are recreated when someone asks for them, which is mostly when
+    # a report is emitted.
+    __slots__ = ("source", "start", "end")
+
     def __init__(self, ctx_start, ctx_end):
         assert ctx_start is None or isinstance(ctx_start, Context)
         assert ctx_end is None or isinstance(ctx_end, Context)
-        self.ctx_start = None if ctx_start is None else ctx_start.save()
-        self.ctx_end = None if ctx_end is None else ctx_end.save()
+        self.source = None if ctx_start is None else ctx_start.source
+        self.start = None if ctx_start is None else ctx_start.pos
+        self.end = None if ctx_end is None else ctx_end.pos
+
+    @property
+    def ctx_start(self):
+        return None if self.start is None else Context(self.source, self.start)
+
+    @ctx_start.setter
+    def ctx_start(self, ctx):
+        self.source = ctx.source
+        self.start = ctx.pos
+
+    @property
+    def ctx_end(self):
+        return None if self.end is None else Context(self.source, self.end)
+
+    @ctx_end.setter
+    def ctx_end(self, ctx):
+        assert ctx.source is self.source
+        self.end = ctx.pos
 
     def text(self):
-        return self.ctx_start.code[self.ctx_start.pos:self.ctx_end.pos]
+        return self.source.code[self.start:self.end]
 
     def __eq__(self, rhs):
         raise NotImplementedError()  # pragma: no cover
 
 
 class ExpressionToken(Token):
+    __slots__ = ()
+
     def resolve(self, state):
         raise NotImplementedError()  # pragma: no cover
 
 
 class Instruction(Token):
+    __slots__ = ("name", "operands")
+
     def __init__(self, ctx_start, ctx_end, name, operands):
         super().__init__(ctx_start, ctx_end)
         self.name = name
@@ -48,6 +76,8 @@ class Instruction(Token):
 
 
 class WordList(Token):
+    __slots__ = ("words",)
+
     def __init__(self, ctx_start, ctx_end, words):
         super().__init__(ctx_start, ctx_end)
         self.words = words
@@ -60,6 +90,8 @@ class WordList(Token):
 
 
 class InstructionPointer(ExpressionToken):
+    __slots__ = ()
+
     def __repr__(self):
         return "."
 
@@ -71,6 +103,8 @@ class InstructionPointer(ExpressionToken):
 
 
 class ParenthesizedExpression(ExpressionToken):
+    __slots__ = ("expr", "opening_parenthesis", "closing_parenthesis")
+
     def __init__(self, ctx_start, ctx_end, expr, opening_parenthesis: str, closing_parenthesis: str):
         super().__init__(ctx_start, ctx_end)
         self.expr = expr
@@ -88,6 +122,8 @@ class ParenthesizedExpression(ExpressionToken):
 
 
 class Symbol(ExpressionToken):
+    __slots__ = ("name", "is_necessarily_label")
+
     def __init__(self, ctx_start, ctx_end, name: str, is_necessarily_label: bool=False):
         super().__init__(ctx_start, ctx_end)
         self.name: str = name
@@ -109,22 +145,11 @@ class Symbol(ExpressionToken):
 
         compiler = state["compiler"]
 
-        candidates = (
-            state["local_symbol_prefix"] + self.name,
-            state["internal_symbol_prefix"] + self.name
-        )
+        name = compiler.find_symbol(state, self.name)
+        if name is not None:
+            return compiler.symbols[name]
 
-        for name in candidates:
-            if name in compiler.symbols:
-                return compiler.symbols[name]
-
-        extern_mapping = compiler.extern_symbols_mapping.get(self.name)
-        if extern_mapping:
-            extern = compiler.symbols.get(extern_mapping[1])
-            if extern:
-                return extern
-
-        not_ready()
+        not_ready(lambda: compiler.find_symbol(state, self.name) is not None)
         # TODO: check if there's a local symbol with the same name defined out of scope
         reports.error(
             "undefined-symbol",
@@ -140,6 +165,8 @@ class Symbol(ExpressionToken):
 
 
 class Label(Token):
+    __slots__ = ("name", "local", "is_extern", "label_error_emitted")
+
     def __init__(self, ctx_start, ctx_end, name: str, is_extern: bool):
         super().__init__(ctx_start, ctx_end)
         self.name: str = name
@@ -154,6 +181,8 @@ class Label(Token):
 
 
 class Assignment(Token):
+    __slots__ = ("target", "value", "is_extern", "assignment_error_emitted")
+
     def __init__(self, ctx_start, ctx_end, target: Symbol, value, is_extern: bool):
         super().__init__(ctx_start, ctx_end)
         self.target: Symbol = target
@@ -168,6 +197,8 @@ class Assignment(Token):
 
 
 class CodeBlock(Token):
+    __slots__ = ("insns", "ctx")
+
     def __init__(self, ctx_start, ctx_end, insns):
         super().__init__(ctx_start, ctx_end)
         self.insns = insns
@@ -180,6 +211,8 @@ class CodeBlock(Token):
 
 
 class AngleBracketedChar(ExpressionToken):
+    __slots__ = ("expr", "reported_error")
+
     def __init__(self, ctx_start, ctx_end, expr):
         super().__init__(ctx_start, ctx_end)
         self.expr = expr
@@ -210,6 +243,8 @@ class AngleBracketedChar(ExpressionToken):
 
 
 class QuotedString(ExpressionToken):
+    __slots__ = ("quote", "string")
+
     def __init__(self, ctx_start, ctx_end, quote, string: str):
         super().__init__(ctx_start, ctx_end)
         self.quote: str = quote
@@ -226,6 +261,8 @@ class QuotedString(ExpressionToken):
 
 
 class StringConcatenation(ExpressionToken):
+    __slots__ = ("chunks",)
+
     def __init__(self, ctx_start, ctx_end, chunks):
         super().__init__(ctx_start, ctx_end)
         self.chunks = chunks
@@ -242,6 +279,8 @@ class StringConcatenation(ExpressionToken):
 
 
 class Number(ExpressionToken):
+    __slots__ = ("representation", "value", "is_valid_label", "invalid_base8", "reported_invalid_base8")
+
     def __init__(self, ctx_start, ctx_end, representation, value, is_valid_label, invalid_base8=False):
         super().__init__(ctx_start, ctx_end)
         self.representation = representation
@@ -268,6 +307,8 @@ class Number(ExpressionToken):
 
 
 class CharLiteral(ExpressionToken):
+    __slots__ = ("representation", "string", "evaluated_value")
+
     def __init__(self, ctx_start, ctx_end, representation, string):
         super().__init__(ctx_start, ctx_end)
         self.representation = representation
@@ -307,6 +348,8 @@ class CharLiteral(ExpressionToken):
 
 
 class File:
+    __slots__ = ("filename", "body")
+
     def __init__(self, filename, body):
         self.filename = filename
         self.body = body
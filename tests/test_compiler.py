@@ -1,10 +1,14 @@
 import itertools
+import os
 import pytest
 import re
 import warnings
 
 from pdpy11 import bk_encoding
 from pdpy11.compiler import Compiler
+from pdpy11.deferred import Deferred, not_ready, put_off, wait
+from pdpy11 import parser
+from pdpy11 import reports
 from pdpy11.parser import parse
 
 from .old_pdpy11.pdpy11.compiler import Compiler as OldCompiler
@@ -84,6 +88,23 @@ def test_two_operands(insn, op1, op2):
     compare_with_old(f"{insn} {op2}, {op1}")
 
 
+@pytest.mark.parametrize(
+    "operand,size",
+    [
+        ("r0", 0), ("pc", 0), ("%5", 0), ("(r3)", 0), ("(r5)+", 0), ("-(r2)", 0), ("@(r1)+", 0),
+        ("@-(r2)", 0), ("@(%5)+", 0), ("#123", 2), ("10", 2), ("@#123", 2), ("@12", 2), ("lbl", 2),
+        ("@lbl", 2), ("#lbl", 2), ("5(r2)", 2), ("lbl(r2)", 2), ("1+lbl(r2)", 2), ("@1(sp)", 2),
+        ("1(%5)", 2)
+    ]
+)
+def test_forward_label_after_operand(operand, size):
+    # Instructions are laid out before they are compiled, so a label after one is placed by the
+    # size of its addressing modes alone
+    base, binary = compile(f"mov {operand}, {operand}\nlbl: .word lbl")
+    assert len(binary) == 2 + 2 * size + 2
+    assert int.from_bytes(binary[-2:], "little") == base + 2 + 2 * size
+
+
 @pytest.mark.parametrize(
     "code",
     [
@@ -183,6 +204,7 @@ def test_metacommands():
 
     expect_same(".repeat 10 { tst #1 }", "tst #1\n" * 8)
     expect_binary(".repeat 10 { .blkb cnt }\ncnt = 10", b"\x00" * 64)
+    expect_same(".repeat 3 { .repeat 2 { .blkb cnt }\n.word . }\nl: .word l\ncnt = 1", ".word 0, 1002, 0, 1006, 0, 1012, 1014")
 
     with util.expect_error("odd-address"):
         expect_same(".byte 1\n.word 2", ".byte 1, 0\n.word 2")
@@ -363,6 +385,9 @@ def test_linear_polynomial():
 
 def test_symbol_propagation():
     expect_same("d = c*2\ne = d*2 + 1\n.link e*3 + 1 - . * 14\n.word .\nc:", ".link 34\n.word .")
+    # The link address depends on itself through c, and cancels out only once the variables of c
+    # are substituted too
+    expect_same("d = c*2\ne = d*2 + 1\n.link e*3 + 1 - . * 14\nc: .word .", ".link 4\n.word .")
 
 
 def test_far_forward_references():
@@ -373,6 +398,141 @@ def test_far_forward_references():
     )
 
 
+def test_deep_linear_forward_references():
+    # Every variable is a linear polynomial in the next one, so resolving a0 substitutes all of them
+    n = 5000
+    expect_same(
+        "".join(f"a{i} = a{i + 1} + 1\n" for i in range(n)) + f"a{n} = 1\n.word a0",
+        f".word {n + 1}."
+    )
+
+
+def test_repeated_label_difference():
+    # The same difference is resolved once and then shared, which must not mix up the results of
+    # expressions built on top of it
+    expect_same(
+        "l1: .blkb n\n.blkb 2\nl2:\n" + ".word l2 - l1, l2 - l1 + 1, (l2 - l1) * 2, l1 - l2\n" * 3 + "n = 4",
+        ".blkb 6\n" + ".word 6, 7, 12., -6\n" * 3
+    )
+
+
+def test_deep_forward_references():
+    # '&' keeps every link from being folded into a linear polynomial, so resolving a0 goes
+    # through all the other symbols, way past the recursion limit
+    n = 10000
+    expect_same(
+        "".join(f"a{i} = (a{i + 1} + 1) & 77777\n" for i in range(n)) + f"a{n} = 1\n.word a0",
+        f".word {n + 1}."
+    )
+
+
+def test_deep_wait_runs_once():
+    # Waiting on a chain this long doesn't fit on the stack, but whatever the computation did
+    # before waiting must not be done again once the chain is resolved
+    calls = []
+    with put_off:
+        chain = Deferred[int](lambda: 1)
+        for _ in range(10000):
+            chain = Deferred[int](lambda prev=chain: wait(prev) + 1)
+
+    def fn():
+        calls.append(None)
+        return wait(chain)
+
+    assert wait(Deferred[int](fn)) == 10001
+    assert len(calls) == 1
+
+
+def test_deferred_is_ready():
+    # A deferred that found something missing tells when it is there without being computed again
+    defined = []
+    def fn():
+        if not defined:
+            not_ready(lambda: bool(defined))
+        return 1
+
+    deferred = Deferred[int](fn)
+    assert not deferred.is_ready()
+    defined.append(None)
+    assert deferred.is_ready()
+    assert wait(deferred) == 1
+
+
+def test_deep_references_to_undefined_symbol():
+    # Every variable refers to the one before, which can't be computed until a0 is defined at the
+    # very end, so there is nothing to compute in advance
+    n = 2000
+    expect_same(
+        f".word a{n}\n" + "".join(f"a{i + 1} = (a{i} + 1) & 77777\n" for i in range(n)) + "a0 = 0",
+        f".word {n}."
+    )
+
+
+def test_unknown_lengths():
+    # The length of every '.blkb' is only known at the very end, so no address after the first one
+    # can be computed until then
+    n = 1000
+    expect_same(
+        ".word last - first\nfirst:\n" + "".join(f".blkb n\nl{i}: .word l{i} - first, last - .\n" for i in range(n)) + "last:\nn = 2",
+        f".word {6 * n}.\n" + "".join(f".blkb 2\n.word {6 * i + 2}., {6 * (n - i) - 2}.\n" for i in range(n))
+    )
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        # Far forward references, way past the statements the deferred engine lays out at once
+        ".word last\n" + "".join(f"l{i}: mov l{i + 1}, @#last\n" for i in range(2000)) + "l2000:\nlast: .word last - l0",
+        # Lengths that are only known at the end are left to the deferred engine
+        ".word last - first\nfirst:\n" + "".join(f".blkb n\nl{i}: .word l{i} - first, last - .\n" for i in range(100)) + "last:\nn = 2",
+        # Instructions whose size depends on the code after them
+        "clr l1\nmov #l1 - l0, r0\nl0: .repeat n { nop }\n.even\nl1: .word l0\nn = 3",
+        "d = c*2\ne = d*2 + 1\n.link e*3 + 1 - . * 14\n.word .\nc:"
+    ]
+)
+def test_two_pass_engine(code):
+    assert compile(code, engine="twopass") == compile(code)
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        Compiler(engine="onepass")
+
+
+@pytest.mark.parametrize("engine", ["deferred", "twopass"])
+def test_report_order(engine):
+    # Data and instructions are compiled after the statements that follow them, but their reports
+    # are still emitted in the order the statements are written
+    emitted = []
+    def report_handler(priority, identifier, *lst_reports):
+        emitted.append((identifier, [repr(ctx_start) for ctx_start, _, _ in lst_reports]))
+
+    with pytest.raises(reports.UnrecoverableError):
+        with reports.handle_reports(report_handler):
+            compile(".word 200000\n.error\nmov #1\n.error\n", engine=engine)
+
+    assert emitted == [
+        ("value-out-of-bounds", ["test.mac:1:7"]),
+        ("user-error", ["test.mac:2:1"]),
+        ("wrong-operands", ["test.mac:3:1"]),
+        ("user-error", ["test.mac:4:1"])
+    ]
+
+
+def test_recursive_definition():
+    with util.expect_error("recursive-definition"):
+        compile("x = x + 1\n.word x")
+    with util.expect_error("recursive-definition"):
+        compile("a = b\nb = a\n.word a")
+    with util.expect_error("recursive-definition"):
+        compile("a = b + 1\nb = c * 2\nc = a & 7\n.word a")
+    with util.expect_error("recursive-definition"):
+        compile("a = b + c\nc = a\nb = 1\n.word a")
+
+    expect_same("a = 1\nb = a + a\nc = b + a\nd = b + c\n.word d", ".word 5")
+    expect_same(".word q\nq = r + s\nr = s\ns = 3", ".word 6")
+
+
 def test_unexpected_register():
     with util.expect_error("unexpected-register"):
         compile("clr r1+1")
@@ -660,6 +820,15 @@ def test_insert_file(fs):
     fs.create_dir("test_dir")
 
     expect_binary("insert_file /test_file/", b"Hello, world!")
+    expect_binary("insert_file /test_file/, 7", b"world!")
+    expect_binary("insert_file /test_file/, 7, 5", b"world")
+    expect_binary("insert_file /test_file/, 13., 0", b"")
+    expect_binary("insert_file /test_file/, 0, 13.", b"Hello, world!")
+
+    with util.expect_error("value-out-of-bounds"):
+        compile("insert_file /test_file/, 14.")
+    with util.expect_error("value-out-of-bounds"):
+        compile("insert_file /test_file/, 7, 7")
 
     with util.expect_error("io-error"):
         compile("insert_file /non_existant_file/")
@@ -808,6 +977,103 @@ def test_include(fs):
     expect_binary(".ascii /start /\n.include /included_link.mac/\n.ascii /end/\n.word .\n.link 3000", b"start \x00\x04Hello, world!end\x18\x06")
 
 
+def test_include_cache(fs):
+    fs.create_file("header.mac", contents=".once\n.word 1")
+    fs.create_file("body.mac", contents=".word 2")
+
+    comp = Compiler()
+    _, binary = comp.compile_and_link_files([parse("/test.mac", ".include /header.mac/\n.include /body.mac/\n.include /header.mac/\n.include /body.mac/")])
+    assert binary == b"\x01\x00\x02\x00\x02\x00"
+    assert comp.times_file_compiled["/header.mac"] == 2
+    assert comp.once_guarded_files == {"/header.mac"}
+    assert set(comp.include_cache) == {"/header.mac", "/body.mac"}
+
+    # A changed file is parsed again
+    assert comp.load_include("/body.mac") == parse("/body.mac", ".word 2")
+    fs.get_object("body.mac").set_contents(".word 3")
+    os.utime("/body.mac", ns=(0, 0))
+    assert comp.load_include("/body.mac") is None
+
+
+def test_prefetch_includes(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "included.mac").write_text(".ascii /b/\n.include \"sub/nested.mac\"\n")
+    (tmp_path / "sub" / "nested.mac").write_text(".word .\nmov: insert_file \"../data.bin\"\n")
+    (tmp_path / "data.bin").write_bytes(b"XYZ")
+    main_path = str(tmp_path / "main.mac")
+    source = ".ascii /a/\n.include /included.mac/\n.include /included.mac/\ninsert_file /data.bin/\n"
+
+    with util.expect_warning("suspicious-name", "suspicious-name"):
+        expected = Compiler().compile_and_link_files([parse(main_path, source)])
+
+    comp = Compiler()
+    file = parse(main_path, source)
+    comp.prefetch_includes([file], 2)
+    assert set(comp.prefetched_includes) == {str(tmp_path / "included.mac"), str(tmp_path / "sub" / "nested.mac")}
+    assert comp.prefetched_insertions == {str(tmp_path / "data.bin"): b"XYZ"}
+
+    # Reports from prefetched files are emitted when the file is included
+    with util.expect_warning("suspicious-name", "suspicious-name"):
+        assert comp.compile_and_link_files([file]) == expected
+    assert not comp.prefetched_includes
+
+
+def test_prefetched_insert_file_range(tmp_path):
+    (tmp_path / "data.bin").write_bytes(b"Hello, world!")
+    main_path = str(tmp_path / "main.mac")
+
+    for source, binary in [
+        ("insert_file /data.bin/, 7, 5\n", b"world"),
+        (".ascii /a/\ninsert_file /data.bin/, 7\n.ascii /b/\n", b"aworld!b"),
+    ]:
+        comp = Compiler()
+        file = parse(main_path, source)
+        comp.prefetch_includes([file], 2)
+        assert comp.prefetched_insertions
+        base, result = comp.compile_and_link_files([file])
+        assert base == 0o1000
+        assert isinstance(result, bytes)
+        assert result == binary
+
+
+def test_prefetched_include_reports(tmp_path):
+    # The parser reports a position it has moved past by the end of the file
+    (tmp_path / "included.mac").write_text(".word 1\n1 2\nhalt\nhalt\n")
+    source = ".include /included.mac/\n"
+
+    def compile_recording_reports(jobs):
+        emitted = []
+        def report_handler(priority, identifier, *lst_reports):
+            emitted.append((identifier, [(repr(ctx_start), repr(ctx_end)) for ctx_start, ctx_end, _ in lst_reports]))
+        comp = Compiler()
+        file = parse(str(tmp_path / "main.mac"), source)
+        if jobs > 1:
+            comp.prefetch_includes([file], jobs)
+        with reports.handle_reports(report_handler):
+            comp.compile_and_link_files([file])
+        return emitted
+
+    path = str(tmp_path / "included.mac")
+    assert compile_recording_reports(1) == compile_recording_reports(2) == [
+        ("missing-newline", [(f"{path}:2:2", f"{path}:2:2"), (f"{path}:2:1", f"{path}:2:2")])
+    ]
+
+
+def test_compile_streaming(monkeypatch):
+    # A tiny window makes statements straddle the tokenized part of the file
+    monkeypatch.setattr(parser, "STREAM_LEXER_WINDOW", 16)
+    files = [
+        ("first.mac", "begin: mov #tail, r0\n.word begin, tail, 2 * c\n.repeat 2 {\n.byte 1, 2\n}\nc = 5\n"),
+        ("second.mac", ".ascii /hello, world/\n.even\ntail:: .word 0\n.end\njunk after end\n")
+    ]
+
+    expected = Compiler().compile_and_link_files([parse(filename, source) for filename, source in files])
+    assert Compiler().compile_and_link_sources(files) == expected
+
+    with util.expect_error("undefined-symbol"):
+        Compiler().compile_and_link_sources([("test.mac", ".word undefined")])
+
+
 
 @pytest.mark.parametrize(
     "extern_declaration",
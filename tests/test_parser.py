@@ -1,7 +1,15 @@
+import gc
+
 import pytest
 
+from pdpy11.cache import ASTCache
+from pdpy11.lexer import Lexer, WHITESPACE, WORD, CHARACTER
 from pdpy11.operators import *
-from pdpy11.parser import parse as parse_
+from pdpy11.context import Context, Source, fold_case
+from pdpy11.parser import parse as parse_, Memo, FAIL, comma, expression, number, symbol_expression, select_statement, label, statement_after_equals_sign, statement_after_word, word_list
+from pdpy11.parallel import parse_files
+from pdpy11.reports import RecoverableError
+from pdpy11 import reports
 from pdpy11.types import *
 
 from . import util
@@ -102,6 +110,14 @@ def test_code_blocks():
     expect_code("insn a {\nb\nc\n}", INSN(A, c(CodeBlock)([c(Instruction)(B, []), c(Instruction)(C, [])])))
 
 
+def test_code_block_context():
+    # Code blocks keep a context for reports, which must not keep the token table alive
+    block = parse("insn a {\nb\n}").body.insns[0].operands[1]
+    assert repr(block.ctx) == "test.mac:1:7"
+    assert block.ctx.source.lexer is None
+    assert not any(isinstance(obj, Lexer) for obj in gc.get_referents(block.ctx))
+
+
 def test_precedence_one():
     expect_code(f"insn +a-", INSN(c(postsub)(c(pos)(A))))
     expect_code(f"insn -a+", INSN(c(postadd)(c(neg)(A))))
@@ -147,6 +163,15 @@ def test_precedence_three():
     expect_code("insn #1 * 2 * 3", INSN(c(immediate)(c(mul)(c(mul)(ONE, TWO), THREE))))
 
 
+def test_precedence_four():
+    expect_code("insn a - b - c", INSN(c(sub)(c(sub)(A, B), C)))
+    expect_code("insn a $ b $ c", INSN(c(call)(A, c(call)(B, C))))
+    expect_code("insn 1 << 2 >> 3 & a", INSN(c(and_)(c(rshift)(c(lshift)(ONE, TWO), THREE), A)))
+    expect_code("insn -#a + b * c", INSN(c(neg)(c(immediate)(c(add)(A, c(mul)(B, C))))))
+    expect_code("insn #-a + b", INSN(c(immediate)(c(add)(c(neg)(A), B))))
+    expect_code("insn @a | b + c-", INSN(c(deferred)(c(or_)(A, c(add)(B, c(postsub)(C))))))
+
+
 @pytest.mark.parametrize(
     "opening,closing",
     [
@@ -324,6 +349,88 @@ def test_context():
     assert repr(parsed.body.insns[1].ctx_start) == "test.mac:2:4"
     assert repr(parsed.body.insns[1].ctx_end) == "test.mac:2:9"
 
+    parsed = parse("\tinsn\n\n\tinsn2 ; comment\n")
+    assert repr(parsed.body.insns[0].ctx_start) == "test.mac:1:5"
+    assert repr(parsed.body.insns[1].ctx_start) == "test.mac:3:5"
+    assert repr(parsed.body.insns[1].ctx_end) == "test.mac:3:10"
+
+    source = parsed.body.insns[0].ctx_start.source
+    assert source is parsed.body.insns[1].ctx_end.source
+    assert source.line_starts == [0, 6, 7, 24]
+    assert source.lines == ["\tinsn", "", "\tinsn2 ; comment", ""]
+    assert source.line_of(5) == 0
+    assert source.line_of(6) == 1
+    assert source.line_of(24) == 3
+
+    ctx = Context(source)
+    ctx_at = ctx.at(7)
+    assert ctx_at.source is source and ctx_at.pos == 7 and ctx.pos == 0
+    assert repr(ctx_at) == "test.mac:3:1"
+
+    # Skipping from the middle of a token, where the lexer has nothing cached
+    ctx = Context(Source("test.mac", "'a  ; comment\n\t; more\n b"))
+    ctx.pos = 3
+    ctx.skip_whitespace()
+    assert ctx.pos == 23
+    ctx.skip_whitespace()
+    assert ctx.pos == 23
+
+    assert fold_case("MOV R0, R1") == "mov r0, r1"
+    assert fold_case("\u0130MOV") == "\u0130mov"
+
+
+def test_failure_protocol():
+    ctx = Context(Source("test.mac", "  x"))
+    assert comma.fn(ctx) is FAIL
+    ctx.pos = 0
+    assert comma(ctx, maybe=True) is None
+    assert ctx.pos == 0
+    with pytest.raises(RecoverableError, match="Failed to match literal at position 2"):
+        comma(ctx)
+    assert (~comma)(ctx, maybe=True) == ""
+    assert (comma | expression)(ctx) == c(Symbol)("x")
+
+    # Rules that raise keep their messages
+    ctx = Context(Source("test.mac", "1x"))
+    with pytest.raises(RecoverableError, match="Local label, not a number"):
+        number(ctx)
+
+
+def test_memo():
+    sources = [
+        "a: mov #1, r0\n.word a, b + 1\nx = <1 + 2> * 3\n1$: br 1$\n",
+        "clr (r0)+\ninsn ^/1/ + 2, -(r1)\n.ascii /abc/ <12>\n",
+        "a, b\ncall 1(r0)\ninsn (1)(2)\n"
+    ]
+    memo = Memo()
+    for source in sources:
+        assert parse_("test.mac", source, memo=memo) == parse(source)
+        assert not memo.table
+    assert memo.misses > 0
+
+    memo = Memo()
+    ctx = Context(Source("test.mac", "a + b", memo))
+    assert expression(ctx, maybe=True, lookahead=True) == c(add)(A, B)
+    assert ctx.pos == 0
+    assert expression(ctx) == c(add)(A, B)
+    assert ctx.pos == 5
+    assert memo.hits == 1
+    assert memo.hit_rate() == memo.hits / (memo.hits + memo.misses)
+
+    # Failures are remembered too
+    memo = Memo()
+    ctx = Context(Source("test.mac", ")", memo))
+    assert expression(ctx, maybe=True) is None
+    assert expression(ctx, maybe=True) is None
+    assert memo.hits == 1
+
+    # Sub-parses that emit reports are not remembered, otherwise the second report would be lost
+    with util.expect_warning("suspicious-name", "suspicious-name"):
+        ctx = Context(Source("test.mac", "mov", Memo()))
+        symbol_expression(ctx, maybe=True, lookahead=True)
+        symbol_expression(ctx)
+        assert ctx.source.memo.hits == 0
+
 
 def test_unexpected_reserved_name():
     with util.expect_warning("suspicious-name"):
@@ -455,6 +562,26 @@ def test_insn_syntax():
         parse("insn%")
 
 
+@pytest.mark.parametrize(
+    "code,statement",
+    [
+        ("a: nop", label),
+        ("a ; comment\n:", label),
+        ("x = 1", statement_after_equals_sign),
+        ("1 = 2", statement_after_equals_sign),
+        ("mov r0, r1", statement_after_word),
+        ("a, b", statement_after_word),
+        ("1$", statement_after_word),
+        ("(r0)+", word_list),
+        ("#1", word_list)
+    ]
+)
+def test_statement_dispatch(code, statement):
+    ctx = Context(Source("test.mac", code))
+    assert select_statement(ctx) is statement
+    assert ctx.pos == 0
+
+
 @pytest.mark.parametrize("name", ["clr", "mov"])
 @pytest.mark.parametrize("arg", ["1", "@#1", "'x", "\"ab", "^rabc", "(1)", "<1>"])
 def test_newlines_with_arguments(name, arg):
@@ -469,3 +596,90 @@ def test_newlines():
         assert parse("mov\n@#0, @#1") == parse("mov @#0, @#1")
     assert parse("mov @#0\n, @#1") == parse("mov @#0, @#1")
     assert parse("mov @#0,\n@#1") == parse("mov @#0, @#1")
+
+
+def test_lexer():
+    lexer = Lexer("lbl: mov r0, 1$ ; comment\n\t.word a.b")
+    assert [
+        (kind, lexer.code[start:end])
+        for kind, start, end in zip(lexer.kinds, lexer.starts, lexer.ends)
+        if kind != CHARACTER
+    ] == [
+        (WORD, "lbl"), (WHITESPACE, " "), (WORD, "mov"), (WHITESPACE, " "), (WORD, "r0"),
+        (WHITESPACE, " "), (WORD, "1$"), (WHITESPACE, " ; comment\n\t"), (WORD, ".word"),
+        (WHITESPACE, " "), (WORD, "a.b")
+    ]
+    assert lexer.folded_text(5, 8) == "mov"
+    assert lexer.match_symbol(0) == 3
+    assert lexer.match_local_symbol(0) == -1
+    assert lexer.match_local_symbol(13) == 15
+    assert lexer.match_instruction_name(27) == 32
+    assert lexer.match_instruction_name(33) == 34
+    # In the middle of a word
+    assert lexer.match_word(34) == 36
+    assert lexer.whitespace_end(15) == 27
+
+    with util.expect_warning("missing-newline"):
+        expect_code("a.b", c(Instruction)(A, []), c(Instruction)(c(Symbol)(".b"), []))
+
+
+def test_ast_cache(tmp_path):
+    cache = ASTCache(str(tmp_path))
+    code = "a: mov #1, r0\n.word a + 2 * 3, <4>\nb = . - a\ninsn a {\nnop\n}\n"
+
+    with util.expect_warning():
+        first = cache.parse("first.mac", code)
+        second = cache.parse("second.mac", code)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert second == File("second.mac", first.body)
+    assert repr(second.body.insns[2].ctx_start) == "second.mac:2:1"
+    assert repr(second.body.insns[4].operands[1].ctx) == "second.mac:4:7"
+    assert second.body.source is second.body.insns[2].operands[0].source
+
+    # Files that emit diagnostics are not cached
+    with util.expect_warning("suspicious-name"):
+        cache.parse("test.mac", "mov: nop\n")
+    with util.expect_warning("suspicious-name"):
+        cache.parse("test.mac", "mov: nop\n")
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # Broken entries are reparsed
+    with open(cache.get_path(code), "wb") as f:
+        f.write(b"garbage")
+    with util.expect_warning():
+        assert cache.parse("first.mac", code) == first
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    # Entries made by other code of pdpy11 are never found
+    other_cache = ASTCache(str(tmp_path))
+    assert other_cache.get_path(code) == cache.get_path(code)
+    other_cache.code_hash = bytes(len(cache.code_hash))
+    with util.expect_warning():
+        assert other_cache.parse("first.mac", code) == first
+    assert (other_cache.hits, other_cache.misses) == (0, 1)
+
+
+def test_parse_files():
+    # d.mac reports a position the parser has moved past by the end of the file
+    files = [("a.mac", "nop\nmov: nop\n"), ("b.mac", "x = 1\n"), ("c.mac", "halt: halt\n"), ("d.mac", ".word 1\n1 2\nhalt\nhalt\n")]
+
+    def record(emitted):
+        def report_handler(priority, identifier, *lst_reports):
+            emitted.append((priority, identifier, [(repr(ctx_start), repr(ctx_end), text) for ctx_start, ctx_end, text in lst_reports]))
+        return reports.handle_reports(report_handler)
+
+    emitted = []
+    with record(emitted):
+        parsed_files = parse_files(files, 2)
+    emitted_serially = []
+    with record(emitted_serially):
+        assert parsed_files == [parse_(filename, code) for filename, code in files]
+    assert emitted == emitted_serially
+    assert [(priority, identifier, lst[0][:2]) for priority, identifier, lst in emitted] == [
+        (reports.warning, "suspicious-name", ("a.mac:2:1", "a.mac:2:5")),
+        (reports.warning, "suspicious-name", ("c.mac:1:1", "c.mac:1:6")),
+        (reports.warning, "missing-newline", ("d.mac:2:2", "d.mac:2:2"))
+    ]
+
+    with util.expect_error("invalid-insn"):
+        parse_files([("a.mac", "nop\n"), ("b.mac", "clr,\n")], 2)
@@ -17,13 +17,14 @@ from . import util
 DATA_ROOT = os.path.join(os.path.dirname(__file__), "practice")
 
 
+@pytest.mark.parametrize("engine", ["deferred", "twopass"])
 @pytest.mark.parametrize("test_name", os.listdir(DATA_ROOT))
-def test_from_file(test_name):
+def test_from_file(test_name, engine):
     source_path = os.path.join(DATA_ROOT, test_name, "code.mac")
     with open(source_path) as f:
         source = f.read()
 
-    comp = Compiler()
+    comp = Compiler(engine=engine)
 
     def report_handler(priority, identifier, *lst_reports):
         if priority != reports.warning:
@@ -33,3 +33,22 @@ def test_repr():
     )
 
     assert repr(parse("test.mac", "mov #1, 4(sp)") == "<test.mac>{ mov #1, 4$sp }")
+
+
+def test_token_spans():
+    file = parse("test.mac", "lbl: mov #1 + 2, r0\n")
+    label, insn = file.body.insns
+    operand = insn.operands[0]
+
+    # Tokens don't carry a __dict__ or contexts of their own, just offsets into the source
+    assert not hasattr(insn, "__dict__")
+    assert not hasattr(operand, "__dict__")
+    assert label.source is insn.source is operand.source
+    assert (insn.start, insn.end) == (5, 19)
+    assert insn.text() == "mov #1 + 2, r0"
+    assert operand.text() == "#1 + 2"
+
+    assert repr(operand.ctx_start) == "test.mac:1:10"
+    assert repr(operand.ctx_end) == "test.mac:1:16"
+    operand.ctx_end = label.ctx_end
+    assert operand.end == 4